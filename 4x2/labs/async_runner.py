@@ -0,0 +1,167 @@
+''' asyncio experiment runner: overlaps host work with acquisitions on the board '''
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class AsyncRunner():
+    """
+    AsyncRunner class
+    Runs a sweep of experiment points, overlapping the host work of the next points with the
+    acquisition and analysis of the current one.
+
+    Each point goes through four steps, all plain (blocking) functions:
+
+    * prepare(point): host work only, e.g. compiling the programs and the resonator register images
+      (SimuChain.compile_resonators). Runs up to lookahead points ahead, in worker threads.
+    * configure(prepared): writes to the firmware, e.g. SimuChain.write_resonators.
+    * acquire(prepared): runs the programs and returns the data.
+    * analyze(point, data): host work on the data, e.g. hist_process. Runs while the next point is acquired.
+
+    Each kind of step has its own threads: prepare runs on lookahead workers, configure and acquire
+    on a single hardware worker (one point at a time, holding lock: share it between runners, or with
+    other threads, that use the same board), and analyze on its own worker, so the acquisitions never
+    wait behind host work. At most max_analyses analyses are pending: beyond that, the sweep waits for
+    the oldest one. Point results are returned in order.
+
+    A readout sweep, where prepare_program is split into compilation and configuration
+    (this is what qick_training.readout_runner does)::
+
+        cache = ProgramCache()
+
+        def prepare(config):
+            cfg, q_adc, q_dac = readout_cfg(soccfg, config, reps)
+            progs = [cache.build(T1Program, soccfg, reps=reps, final_delay=1.0, cfg=dict(cfg, do_jump=do_jump))
+                     for do_jump in [False, True]]
+            return cfg, q_adc, q_dac, progs
+
+        def configure(prepared):
+            cfg, q_adc, q_dac, progs = prepared
+            soc.config_resonator(dt=cfg['decay_delay'], f=cfg['f_res'], df=-cfg['df_res'], c0=cfg['c0'], c1=cfg['c1'],
+                                 q_dac=q_dac, q_adc=q_adc)
+
+        def acquire(prepared):
+            progs = prepared[3]
+            for prog in progs:
+                prog.acquire(soc, soft_avgs=1)
+            return [prog.get_raw()[0].reshape([-1,2]) for prog in progs]
+
+        def analyze(config, iq):
+            return hist_process([iq[0][:,0], iq[0][:,1], iq[1][:,0], iq[1][:,1]], plot=False)
+
+        runner = AsyncRunner(prepare, configure, acquire, analyze)
+        results = await runner.run(configs)     # or runner.run_sync(configs) outside of Jupyter
+        print(runner.stats['duty_cycle'])
+    """
+    def __init__(self, prepare, configure=None, acquire=None, analyze=None, lookahead=1, lock=None, max_analyses=2):
+        """
+        Parameters
+        ----------
+        prepare : callable
+            prepare(point) -> prepared, host work
+        configure : callable
+            configure(prepared), firmware writes (optional)
+        acquire : callable
+            acquire(prepared) -> data, acquisition (optional: data is then the prepared point)
+        analyze : callable
+            analyze(point, data) -> result, host work (optional: result is then the data)
+        lookahead : int
+            number of points prepared ahead of the one being acquired
+        lock : threading.Lock
+            lock held during configure and acquire (default: a lock private to this runner)
+        max_analyses : int
+            largest number of analyses pending (running or queued) while the sweep goes on
+        """
+        self.logger    = logging.getLogger(self.__class__.__name__)
+        self.prepare   = prepare
+        self.configure = configure
+        self.acquire   = acquire
+        self.analyze   = analyze
+        self.lookahead = lookahead
+        self.lock      = threading.Lock() if lock is None else lock
+        self.max_analyses = max_analyses
+        self.stats     = {}
+
+    def _timed(self, step, times, fn, *args):
+        t0 = time.perf_counter()
+        ret = fn(*args)
+        times[step] = time.perf_counter() - t0
+        return ret
+
+    def _hardware(self, prepared, times):
+        # Configure and acquire one point, holding the hardware lock.
+        with self.lock:
+            if self.configure is not None:
+                self._timed('configure', times, self.configure, prepared)
+            if self.acquire is not None:
+                return self._timed('acquire', times, self.acquire, prepared)
+            return prepared
+
+    async def run(self, points):
+        """Run the sweep; returns the result of each point, in order.
+        Timing is logged and kept in self.stats (see stats_report).
+        """
+        points = list(points)
+        n = len(points)
+        loop = asyncio.get_running_loop()
+        times = [{} for point in points]
+        results = [None]*n
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, self.lookahead)) as prep_pool, \
+             ThreadPoolExecutor(max_workers=1) as hw_pool, \
+             ThreadPoolExecutor(max_workers=1) as ana_pool:
+            def start(i):
+                return loop.run_in_executor(prep_pool, self._timed, 'prepare', times[i], self.prepare, points[i])
+
+            preparing = {i : start(i) for i in range(min(self.lookahead+1, n))}
+            analyzing = []
+            for i in range(n):
+                prepared = await preparing.pop(i)
+                if i + self.lookahead + 1 < n:
+                    preparing[i + self.lookahead + 1] = start(i + self.lookahead + 1)
+
+                data = await loop.run_in_executor(hw_pool, self._hardware, prepared, times[i])
+
+                if self.analyze is not None:
+                    # Bound the pending analyses (and the data they hold).
+                    while len(analyzing) >= self.max_analyses:
+                        j, future = analyzing.pop(0)
+                        results[j] = await future
+                    analyzing.append((i, loop.run_in_executor(ana_pool, self._timed, 'analyze', times[i], self.analyze, points[i], data)))
+                else:
+                    results[i] = data
+
+            for i, future in analyzing:
+                results[i] = await future
+        wall = time.perf_counter() - t0
+
+        self.stats = self.stats_report(times, wall)
+        self.logger.info("run %s"%({key : self.stats[key] for key in ['points', 'wall', 'duty_cycle', 'speedup']}))
+        return results
+
+    def run_sync(self, points):
+        """Blocking version of run, for scripts (in Jupyter, which has a running event loop, use await run).
+        """
+        return asyncio.run(self.run(points))
+
+    def stats_report(self, times, wall):
+        """Summary of a run.
+
+        Returns
+        -------
+        dict
+            points, wall time (s), total time of each step (s), duty_cycle (fraction of the wall time
+            spent acquiring), serial (time the steps would take one after another) and speedup (serial/wall)
+        """
+        steps = ['prepare', 'configure', 'acquire', 'analyze']
+        totals = {step : sum(t.get(step, 0) for t in times) for step in steps}
+        serial = sum(totals.values())
+        return {'points'     : len(times),
+                'wall'       : wall,
+                'steps'      : totals,
+                'duty_cycle' : totals['acquire']/wall if wall > 0 else 0.0,
+                'serial'     : serial,
+                'speedup'    : serial/wall if wall > 0 else 1.0,
+                'times'      : times}
@@ -1,7 +1,123 @@
+import time
+import threading
 import numpy as np
-from qick.qick import SocIp
+from drivers.shadow import ShadowSocIp
 
-class AxisKidsimV3(SocIp):
+# Register image of one resonator (one field per kidsim register, in address order).
+REGS_DTYPE = np.dtype([('bval'  , np.int64),
+                       ('slope' , np.int64),
+                       ('steps' , np.int64),
+                       ('wait'  , np.int64),
+                       ('freq'  , np.int64),
+                       ('c0'    , np.int64),
+                       ('c1'    , np.int64),
+                       ('g'     , np.int64),
+                       ('outsel', np.int64),
+                       ('punct' , np.int64),
+                       ('addr'  , np.int64)])
+
+# Resonator table entry: register image of one lane, and whether it is known.
+TABLE_DTYPE = np.dtype(REGS_DTYPE.descr + [('valid', bool)])
+
+# Output selection (any other value selects output 3).
+OUTSEL = {'resonator' : 0, 'dds' : 1, 'input' : 2}
+
+def compile_resonator_regs(channel, dds_freq, sweep_freq, sweep_time, nstep, c0, c1, sel, L, fs_dds, dds_wait=1, b_dds=16, b_coef=16):
+    """Compile arrays of resonator parameters into kidsim register values.
+
+    This is the array version of AxisKidsimV3.set_resonator_config + set_resonator_regs.
+    It has no side effects, so register images can be precomputed without hardware.
+    All parameters are broadcast against each other.
+
+    Parameters
+    ----------
+    channel : array of int
+        PFB channel
+    dds_freq : array of float
+        DDS frequency, in MHz
+    sweep_freq : array of float
+        size of the frequency sweep, in MHz
+    sweep_time : array of float
+        duration of the sweep, in us
+    nstep : array of int, or None
+        number of sweep steps; where None or NaN, the number of steps is set by dds_wait
+    c0 : array of float
+        IIR c0 coefficient
+    c1 : array of float
+        IIR c1 coefficient
+    sel : array of str or int
+        output selection ('resonator', 'dds', 'input'), or outsel register value
+    L : int
+        number of lanes of the block
+    fs_dds : float
+        DDS sampling frequency, in Hz
+    dds_wait : array of int
+        wait between sweep steps, used where nstep is not given
+    b_dds : int
+        DDS bits
+    b_coef : int
+        coefficient/gain bits
+
+    Returns
+    -------
+    numpy.ndarray
+        REGS_DTYPE array of register values
+    numpy.ndarray
+        sweep_time, updated where the slope was clamped
+    numpy.ndarray
+        boolean mask of the entries where the slope was clamped to 1
+    """
+    if nstep is None:
+        nstep = np.nan
+    channel, dds_freq, sweep_freq, sweep_time, nstep, c0, c1, sel, dds_wait = np.broadcast_arrays(
+        channel, dds_freq, sweep_freq, sweep_time, nstep, c0, c1, sel, dds_wait)
+    channel    = channel.astype(np.int64)
+    sweep_time = sweep_time.astype(float)
+    nstep      = nstep.astype(float)
+
+    # DDS sampling period (us) and frequency resolution (Hz).
+    ts = 1/(fs_dds/1e6)
+    df = fs_dds/2**b_dds
+
+    # nstep sets dds_wait; otherwise dds_wait sets nstep.
+    has_nstep = ~np.isnan(nstep)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dds_wait = np.where(has_nstep, np.trunc(sweep_time/(nstep*ts)) - 1, dds_wait)
+    nstep = np.where(has_nstep, nstep, np.trunc(sweep_time/((dds_wait+1)*ts)))
+    if np.any(nstep == 0):
+        raise ValueError("sweep_time too short: nstep = 0 for channels %s" % (channel[nstep == 0]))
+
+    # Sanity check (slope = 0).
+    dds_bval  = np.round(sweep_freq*1e6/df)
+    dds_slope = np.round(dds_bval/nstep)
+    clamp     = dds_slope < 1
+    dds_slope = np.where(clamp, 1, dds_slope)
+    nstep     = np.where(clamp, dds_bval, nstep)
+    sweep_time = np.where(clamp, nstep*((dds_wait+1)*ts), sweep_time)
+
+    # Output selection.
+    if sel.dtype.kind in 'UO':
+        outsel = np.full(sel.shape, 3, dtype=np.int64)
+        for name, value in OUTSEL.items():
+            outsel[sel == name] = value
+    else:
+        outsel = sel
+
+    regs = np.zeros(channel.shape, dtype=REGS_DTYPE)
+    regs['bval']   = dds_bval
+    regs['slope']  = dds_slope
+    regs['steps']  = nstep
+    regs['wait']   = dds_wait
+    regs['freq']   = np.round(dds_freq*1e6/df)
+    regs['c0']     = np.round(c0*(2**(b_coef-1)))
+    regs['c1']     = np.round(c1*(2**(b_coef-1)))
+    regs['g']      = np.round((1+c1)/(1+c0)*(2**(b_coef-1)))
+    regs['outsel'] = outsel
+    regs['punct']  = channel//L
+    regs['addr']   = np.mod(channel, L)
+    return regs, sweep_time, clamp
+
+class AxisKidsimV3(ShadowSocIp):
     bindto = ['user.org:user:axis_kidsim_v3:1.0']
     
     # Sampling frequency and frequency resolution (Hz).
@@ -13,6 +129,9 @@ class AxisKidsimV3(SocIp):
 
     # Coefficient/gain bits.
     B_COEF = 16
+
+    # Write enable pulse must always reach the block.
+    VOLATILE_REGS = ('we_reg',)
     
     def __init__(self, description):
         # Initialize ip
@@ -38,6 +157,13 @@ class AxisKidsimV3(SocIp):
         self.L      = int(description['parameters']['L'])
         self.NCH    = 256
         self.NPUNCT = int(self.NCH/self.L)
+
+        # Resonator table: what was last written to each lane.
+        # Each lane holds one resonator, placed on the channel selected by its punct_id.
+        self.table = np.zeros(self.L, dtype=TABLE_DTYPE)
+
+        # Serializes register writes, so that concurrent callers cannot interleave the write enable pulses.
+        self.lock = threading.RLock()
         
     def configure(self, fs):
         self.logger.debug("configure %s"%(fs))
@@ -47,22 +173,158 @@ class AxisKidsimV3(SocIp):
         
     def set_registers(self, dds_bval, dds_slope, dds_steps, dds_wait, dds_freq, iir_c0, iir_c1, iir_g, outsel, punct_id, addr):
         self.logger.debug("set_registers %s"%([dds_bval, dds_slope, dds_steps, dds_wait, dds_freq, iir_c0, iir_c1, iir_g, outsel, punct_id, addr]))
-        self.dds_bval_reg  = dds_bval
-        self.dds_slope_reg = dds_slope
-        self.dds_steps_reg = dds_steps
-        self.dds_wait_reg  = dds_wait
-        self.dds_freq_reg  = dds_freq
-        self.iir_c0_reg    = iir_c0
-        self.iir_c1_reg    = iir_c1
-        self.iir_g_reg     = iir_g
-        self.outsel_reg    = outsel
-        self.punct_id_reg  = punct_id
-        self.addr_reg      = addr
-        
-        # Write enable pulse.
-        self.we_reg     = 1
-        self.we_reg     = 0
-        
+        self._write_registers(dds_bval, dds_slope, dds_steps, dds_wait, dds_freq, iir_c0, iir_c1, iir_g, outsel, punct_id, addr)
+
+    def _write_registers(self, dds_bval, dds_slope, dds_steps, dds_wait, dds_freq, iir_c0, iir_c1, iir_g, outsel, punct_id, addr):
+        with self.lock:
+            self.dds_bval_reg  = dds_bval
+            self.dds_slope_reg = dds_slope
+            self.dds_steps_reg = dds_steps
+            self.dds_wait_reg  = dds_wait
+            self.dds_freq_reg  = dds_freq
+            self.iir_c0_reg    = iir_c0
+            self.iir_c1_reg    = iir_c1
+            self.iir_g_reg     = iir_g
+            self.outsel_reg    = outsel
+            self.punct_id_reg  = punct_id
+            self.addr_reg      = addr
+            
+            # Write enable pulse.
+            self.we_reg     = 1
+            self.we_reg     = 0
+
+            # Keep track of the lane contents.
+            if 0 <= addr < self.L:
+                self.table[addr] = (dds_bval, dds_slope, dds_steps, dds_wait, dds_freq, iir_c0, iir_c1, iir_g, outsel, punct_id, addr, True)
+
+    def lookup(self, channel):
+        """Table entry of the resonator placed on a PFB channel, or None if the channel has none.
+        """
+        entry = self.table[channel % self.L]
+        if entry['valid'] and entry['punct'] == channel//self.L:
+            return entry.copy()
+        return None
+
+    def snapshot(self):
+        """Copy of the resonator table, to be given back to restore().
+        """
+        return self.table.copy()
+
+    def unchanged(self, regs):
+        """Mask of the register images (REGS_DTYPE rows) that their lane already holds.
+        """
+        regs  = np.atleast_1d(regs)
+        lanes = np.clip(regs['addr'], 0, self.L-1)
+        entries = self.table[lanes]
+        same = entries['valid'] & (regs['addr'] == lanes)
+        for name in REGS_DTYPE.names:
+            same &= entries[name] == regs[name]
+        return same
+
+    def restore(self, snapshot, diff = True, verbose = False):
+        """Program the lanes back to a snapshot.
+
+        Parameters
+        ----------
+        snapshot : numpy.ndarray
+            TABLE_DTYPE array returned by snapshot()
+        diff : bool
+            only rewrite the lanes that differ from the current table
+
+        Returns
+        -------
+        int
+            number of lanes written
+        """
+        self.logger.debug("restore diff=%s"%(diff))
+        rows = snapshot['valid'].copy()
+        if diff:
+            rows &= ~(self.table['valid'] & (self.table == snapshot))
+        self.write_resonators(snapshot[rows], verbose)
+        return int(np.count_nonzero(rows))
+
+    def shadow_invalidate(self):
+        super().shadow_invalidate()
+        # Lane memory is shadowed by the resonator table.
+        self.table['valid'] = False
+
+    def set_resonators(self, configs, verbose = False):
+        """Program several resonators in one pass.
+
+        The register values of all resonators are computed at once (see resonator_regs)
+        and then streamed to the block. The config dicts are not modified.
+
+        Parameters
+        ----------
+        configs : list of dict
+            resonator configs, with the same keys as for set_resonator
+            (channel, dds_freq, sweep_freq, sweep_time, nstep or dds_wait, iir_c0, iir_c1, sel)
+
+        Returns
+        -------
+        dict
+            timing of the call: number of resonators, compile and write times (s)
+        """
+        self.logger.debug("set_resonators %d configs"%(len(configs)))
+        t0 = time.perf_counter()
+        regs = self.resonator_regs(configs)
+        t1 = time.perf_counter()
+        self.write_resonators(regs, verbose)
+        t2 = time.perf_counter()
+
+        timing = {'n' : len(regs), 'compile' : t1-t0, 'write' : t2-t1}
+        self.logger.debug("set_resonators timing %s"%(timing))
+        return timing
+
+    def write_resonators(self, regs, verbose = False):
+        """Write a precomputed register image (REGS_DTYPE array), one resonator per row.
+        """
+        with self.lock:
+            for row in np.atleast_1d(regs)[list(REGS_DTYPE.names)].tolist():
+                if verbose:
+                    print('{}: {}'.format(self.__class__.__name__, dict(zip(REGS_DTYPE.names, row))))
+                self._write_registers(*row)
+
+    def resonator_regs(self, configs):
+        """Compute the register image of several resonators with array math.
+
+        Missing keys take the same defaults as in set_resonator_config.
+
+        Parameters
+        ----------
+        configs : list of dict
+            resonator configs
+
+        Returns
+        -------
+        numpy.ndarray
+            REGS_DTYPE array with one row per config
+        """
+        def column(key, default):
+            return np.array([config.get(key, default) for config in configs], dtype=float)
+
+        # Configs without nstep use dds_wait instead.
+        regs, sweep_time, clamp = self.compile_regs(
+            channel    = column('channel', 0).astype(np.int64),
+            dds_freq   = column('dds_freq', 0),
+            sweep_freq = column('sweep_freq', 0.9),
+            sweep_time = column('sweep_time', 100),
+            nstep      = column('nstep', np.nan),
+            c0         = column('iir_c0', 0.99),
+            c1         = column('iir_c1', 0.8),
+            sel        = np.array([config.get('sel', 'resonator') for config in configs]),
+            dds_wait   = column('dds_wait', 1))
+
+        if np.any(clamp):
+            print('{}: Updated sweep_time to {} us for channels {}. Try increasing dds_wait.'
+                  .format(self.__class__.__name__, sweep_time[clamp], regs['punct'][clamp]*self.L + regs['addr'][clamp]))
+        return regs
+
+    def compile_regs(self, channel, dds_freq=0, sweep_freq=0.9, sweep_time=100, nstep=None, c0=0.99, c1=0.8, sel='resonator', dds_wait=1):
+        """compile_resonator_regs with the parameters of this block.
+        """
+        return compile_resonator_regs(channel, dds_freq, sweep_freq, sweep_time, nstep, c0, c1, sel,
+                                      L=self.L, fs_dds=self.FS_DDS, dds_wait=dds_wait, b_dds=self.B_DDS, b_coef=self.B_COEF)
     
     def set_resonator(self, config, verbose = False):
         self.logger.debug("set_resonator %s"%(config))
@@ -149,6 +411,11 @@ class AxisKidsimV3(SocIp):
     
     def set_resonator_regs(self, config, verbose = False):
         self.logger.debug("set_resonator_regs %s"%(config))
+        self.set_registers(*self.config_regs(config, verbose))
+
+    def config_regs(self, config, verbose = False):
+        """Register values (in REGS_DTYPE order) of a config completed by set_resonator_config.
+        """
         # DDS Section Registers.
         dds_bval_reg  = config['dds_bval_reg']
         dds_slope_reg = config['dds_slope_reg']
@@ -186,19 +453,17 @@ class AxisKidsimV3(SocIp):
             print('sel = {}, punct_id = {}, addr = {}'
                   .format(outsel_reg, punct_id_reg, addr_reg))
 
-        # Set Registers.
-        self.set_registers(
-            dds_bval_reg ,
-            dds_slope_reg,
-            dds_steps_reg,
-            dds_wait_reg ,
-            dds_freq_reg ,
-            iir_c0_reg   ,
-            iir_c1_reg   ,
-            iir_g_reg    ,
-            outsel_reg   ,
-            punct_id_reg ,
-            addr_reg     )                        
+        return [dds_bval_reg ,
+                dds_slope_reg,
+                dds_steps_reg,
+                dds_wait_reg ,
+                dds_freq_reg ,
+                iir_c0_reg   ,
+                iir_c1_reg   ,
+                iir_g_reg    ,
+                outsel_reg   ,
+                punct_id_reg ,
+                addr_reg     ]
         
 
     def setall(self, config, verbose = False):
@@ -1,7 +1,132 @@
+import os
+import json
+import hashlib
 import numpy as np
-from qick.qick import SocIp
+from drivers.shadow import ShadowSocIp
 
-class AbsPfbAnalysis(SocIp):
+class TopologyCache():
+    """
+    TopologyCache class
+    On-disk cache of the connections traced by the PFB drivers.
+
+    Entries are keyed by the block path, and the cache file by a hash of the hwh file,
+    so a new firmware gets a new (empty) cache and is traced again.
+    """
+    def __init__(self, hwh, path=None):
+        """
+        Parameters
+        ----------
+        hwh : str
+            path of the hardware handoff (hwh) file of the firmware
+        path : str
+            cache directory, default ~/.cache/qick_training
+        """
+        with open(hwh, 'rb') as f:
+            self.key = hashlib.sha256(f.read()).hexdigest()[:16]
+
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.cache', 'qick_training')
+        self.fname = os.path.join(path, 'topology_%s.json' % (self.key))
+
+        self.entries = {}
+        if os.path.exists(self.fname):
+            with open(self.fname) as f:
+                self.entries = json.load(f)
+        self.dirty = False
+
+    def get(self, fullpath):
+        return self.entries.get(fullpath)
+
+    def put(self, fullpath, entry):
+        self.entries[fullpath] = entry
+        self.dirty = True
+
+    def save(self):
+        if self.dirty:
+            os.makedirs(os.path.dirname(self.fname), exist_ok=True)
+            tmp = self.fname + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f, indent=1)
+            os.replace(tmp, self.fname)
+            self.dirty = False
+
+def pfb_channel_centers(fs, N):
+    """Center frequency of the N channels of a PFB running at fs.
+    Channel k is centered at k*fs/N; channels N/2 and above are the negative frequencies.
+    """
+    ch = np.arange(N)
+    return np.where(ch >= N/2, ch - N, ch)*(fs/N)
+
+# Scalar types of the fast paths of pfb_freq2ch/pfb_ch2freq.
+_INT_TYPES   = (int, np.integer)
+_FLOAT_TYPES = (float, int, np.floating, np.integer)
+
+def _out_of_range(x, out_of_range, name, allowed):
+    # Apply the out-of-range policy to a scalar.
+    if out_of_range == 'raise':
+        raise ValueError("%s value %s out of allowed range %s" % (name, x, allowed))
+    elif out_of_range == 'mask':
+        return np.ma.masked
+    raise ValueError("out_of_range must be 'raise' or 'mask', not %s" % (out_of_range))
+
+def _check_range(value, valid, x, out_of_range, name, allowed):
+    # Apply the out-of-range policy to a vectorized result.
+    if out_of_range == 'raise':
+        if not np.all(valid):
+            raise ValueError("%s value %s out of allowed range %s" % (name, x[~valid], allowed))
+    elif out_of_range == 'mask':
+        value = np.ma.masked_array(value, mask=~valid)
+    else:
+        raise ValueError("out_of_range must be 'raise' or 'mask', not %s" % (out_of_range))
+    return value[()] if np.ndim(value) == 0 else value
+
+def pfb_freq2ch(f, fs, N, out_of_range='raise'):
+    """PFB channel of baseband frequencies.
+
+    Parameters
+    ----------
+    f : float or array
+        frequency, in the range -fs/2 .. fs/2
+    fs : float
+        PFB sampling frequency
+    N : int
+        number of channels
+    out_of_range : str
+        'raise' to raise ValueError for frequencies out of range, 'mask' to return a masked array
+
+    Returns
+    -------
+    int or numpy.ndarray
+        channel number(s)
+    """
+    if isinstance(f, _FLOAT_TYPES) and not isinstance(f, bool):
+        # Scalar fast path (the common case, e.g. set_resonator).
+        if -fs/2 < f < fs/2:
+            return int(round(f/(fs/N))) % N
+        return _out_of_range(f, out_of_range, "Frequency", "(%f,%f)" % (-fs/2, fs/2))
+
+    f = np.asarray(f, dtype=float)
+    valid = (-fs/2 < f) & (f < fs/2)
+    k = np.mod(np.round(f/(fs/N)), N).astype(np.int64)
+    k = _check_range(k, valid, f, out_of_range, "Frequency", "(%f,%f)" % (-fs/2, fs/2))
+    return int(k) if isinstance(k, np.integer) else k
+
+def pfb_ch2freq(ch, centers, out_of_range='raise'):
+    """Center frequency of PFB channels, looked up in the table from pfb_channel_centers.
+    """
+    if isinstance(ch, _INT_TYPES) and not isinstance(ch, bool):
+        # Scalar fast path.
+        if 0 <= ch < len(centers):
+            return float(centers[ch])
+        return _out_of_range(ch, out_of_range, "Channel", "[0,%d]" % (len(centers)-1))
+
+    ch = np.asarray(ch, dtype=np.int64)
+    valid = (0 <= ch) & (ch < len(centers))
+    f = centers[np.where(valid, ch, 0)]
+    f = _check_range(f, valid, ch, out_of_range, "Channel", "[0,%d]" % (len(centers)-1))
+    return float(f) if isinstance(f, np.floating) else f
+
+class AbsPfbAnalysis(ShadowSocIp):
     # Trace parameters.
     STREAM_IN_PORT	= 's_axis'
     STREAM_OUT_PORT = 'm_axis'
@@ -16,6 +141,10 @@ class AbsPfbAnalysis(SocIp):
     HAS_DMA         = False
     HAS_KIDSIM      = False
 
+    # Connection state kept in the topology cache.
+    TOPOLOGY_FLAGS  = ['HAS_ADC', 'HAS_DDSCIC', 'HAS_DDS_DUAL', 'HAS_CIC', 'HAS_CHSEL', 'HAS_STREAMER', 'HAS_DMA', 'HAS_KIDSIM']
+    TOPOLOGY_KEYS   = ['adc', 'dma', 'kidsim', 'ddscic', 'dds', 'cic', 'chsel', 'streamer']
+
     def configure(self, fs):
         # Channel centers.
         fc = fs/self.dict['N']
@@ -25,10 +154,35 @@ class AbsPfbAnalysis(SocIp):
 
         # Add data into dictionary.
         self.dict['freq'] = {'fs' : fs, 'fc' : fc, 'fb' : fb}
+
+        # Center frequency of every channel.
+        self.dict['freq']['centers'] = pfb_channel_centers(fs, self.dict['N'])
     
     def configure_connections(self, soc):
         self.soc = soc
 
+        # Use the topology cache if the soc has one.
+        cache = getattr(soc, 'topology_cache', None)
+        if cache is not None:
+            entry = cache.get(self.fullpath)
+            if entry is not None:
+                self.load_topology(entry)
+            else:
+                self.trace_connections(soc)
+                cache.put(self.fullpath, self.dump_topology())
+        else:
+            self.trace_connections(soc)
+
+    def dump_topology(self):
+        return {'flags' : {flag : getattr(self, flag) for flag in self.TOPOLOGY_FLAGS},
+                'dict'  : {key : self.dict[key] for key in self.TOPOLOGY_KEYS if key in self.dict}}
+
+    def load_topology(self, entry):
+        for flag, value in entry['flags'].items():
+            setattr(self, flag, value)
+        self.dict.update(entry['dict'])
+
+    def trace_connections(self, soc):
         ##################################################
         ### Backward tracing: should finish at the ADC ###
         ##################################################
@@ -204,22 +358,11 @@ class AbsPfbAnalysis(SocIp):
                 raise RuntimeError("Cannot find correspondance with any ADC for ports %s,%s" % (port0,port1))
             return tile0, adc0
 
-    def freq2ch(self,f):
-        # Check if frequency is on -fs/2 .. fs/2.
-        if ( -self.dict['freq']['fs']/2 < f < self.dict['freq']['fs']/2):
-            k = np.round(f/self.dict['freq']['fc'])
+    def freq2ch(self, f, out_of_range='raise'):
+        return pfb_freq2ch(f, self.dict['freq']['fs'], self.dict['N'], out_of_range)
 
-            if k >= 0:
-                return int(k)
-            else:
-                return int (self.dict['N'] + k)
-
-    def ch2freq(self,ch):
-        if ch >= self.dict['N']/2:
-            ch_ = self.dict['N'] - ch
-            return -(ch_*self.dict['freq']['fc'])
-        else:
-            return ch*self.dict['freq']['fc']
+    def ch2freq(self, ch, out_of_range='raise'):
+        return pfb_ch2freq(ch, self.dict['freq']['centers'], out_of_range)
 
     def qout(self, qout):
         self.qout_reg = qout
@@ -245,7 +388,7 @@ class AxisPfbAnalysis(AbsPfbAnalysis):
         self.dict = {}
         self.dict['N'] = int(description['parameters']['N'])
 
-class AbsPfbSynthesis(SocIp):
+class AbsPfbSynthesis(ShadowSocIp):
     # Trace parameters.
     STREAM_IN_PORT	= 's_axis'
     STREAM_OUT_PORT = 'm_axis'
@@ -256,6 +399,10 @@ class AbsPfbSynthesis(SocIp):
     HAS_DDS_DUAL    = False
     HAS_KIDSIM      = False
 
+    # Connection state kept in the topology cache.
+    TOPOLOGY_FLAGS  = ['HAS_DAC', 'HAS_DDS', 'HAS_DDS_DUAL', 'HAS_KIDSIM']
+    TOPOLOGY_KEYS   = ['dac', 'dds', 'kidsim']
+
     def configure(self, fs):
         # Channel centers.
         fc = fs/self.dict['N']
@@ -265,10 +412,35 @@ class AbsPfbSynthesis(SocIp):
 
         # Add data into dictionary.
         self.dict['freq'] = {'fs' : fs, 'fc' : fc, 'fb' : fb}
+
+        # Center frequency of every channel.
+        self.dict['freq']['centers'] = pfb_channel_centers(fs, self.dict['N'])
     
     def configure_connections(self, soc):
         self.soc = soc
 
+        # Use the topology cache if the soc has one.
+        cache = getattr(soc, 'topology_cache', None)
+        if cache is not None:
+            entry = cache.get(self.fullpath)
+            if entry is not None:
+                self.load_topology(entry)
+            else:
+                self.trace_connections(soc)
+                cache.put(self.fullpath, self.dump_topology())
+        else:
+            self.trace_connections(soc)
+
+    def dump_topology(self):
+        return {'flags' : {flag : getattr(self, flag) for flag in self.TOPOLOGY_FLAGS},
+                'dict'  : {key : self.dict[key] for key in self.TOPOLOGY_KEYS if key in self.dict}}
+
+    def load_topology(self, entry):
+        for flag, value in entry['flags'].items():
+            setattr(self, flag, value)
+        self.dict.update(entry['dict'])
+
+    def trace_connections(self, soc):
         #########################################################
         ### Backward tracing: should finish at the DDS/KIDSIM ###
         #########################################################
@@ -417,22 +589,11 @@ class AbsPfbSynthesis(SocIp):
         raise RuntimeError("Cannot find correspondance with any DAC for port %s" % (port))
 
 
-    def freq2ch(self,f):
-        # Check if frequency is on -fs/2 .. fs/2.
-        if ( -self.dict['freq']['fs']/2 < f < self.dict['freq']['fs']/2):
-            k = np.round(f/self.dict['freq']['fc'])
+    def freq2ch(self, f, out_of_range='raise'):
+        return pfb_freq2ch(f, self.dict['freq']['fs'], self.dict['N'], out_of_range)
 
-            if k >= 0:
-                return int(k)
-            else:
-                return int (self.dict['N'] + k)
-
-    def ch2freq(self,ch):
-        if ch >= self.dict['N']/2:
-            ch_ = self.dict['N'] - ch
-            return -(ch_*self.dict['freq']['fc'])
-        else:
-            return ch*self.dict['freq']['fc']
+    def ch2freq(self, ch, out_of_range='raise'):
+        return pfb_ch2freq(ch, self.dict['freq']['centers'], out_of_range)
 
     def qout(self, value):
         self.qout_reg = value
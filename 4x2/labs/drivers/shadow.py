@@ -0,0 +1,52 @@
+try:
+    from qick.qick import SocIp
+except ImportError:
+    # No pynq (not on a board): drivers run on the mock backend.
+    from drivers.mock import SocIp
+
+class ShadowSocIp(SocIp):
+    """
+    ShadowSocIp class
+    SocIp with an opt-in shadow copy of its registers.
+
+    With the shadow enabled, the last value written to each register is kept and
+    writes of an unchanged value are skipped (and counted). Registers listed in
+    VOLATILE_REGS (e.g. write-enable pulses) are always written.
+    The shadow must be invalidated when the registers change behind the driver's
+    back, e.g. after a bitstream reload.
+    """
+    # Registers that are always written.
+    VOLATILE_REGS = ()
+
+    # Shadow is disabled by default.
+    shadow_enabled = False
+    shadow_writes  = 0
+    shadow_skipped = 0
+
+    def shadow_enable(self, enable=True):
+        self.logger.debug("shadow_enable %s"%(enable))
+        self.shadow_enabled = enable
+        self.shadow_invalidate()
+
+    def shadow_invalidate(self):
+        self.logger.debug("shadow_invalidate")
+        self._shadow = {}
+
+    def shadow_stats(self, reset=False):
+        stats = {'writes' : self.shadow_writes, 'skipped' : self.shadow_skipped}
+        if reset:
+            self.shadow_writes  = 0
+            self.shadow_skipped = 0
+        return stats
+
+    def __setattr__(self, a, v):
+        if self.shadow_enabled and a in self.REGISTERS and a not in self.VOLATILE_REGS:
+            v = int(v)
+            if self._shadow.get(a) == v:
+                self.shadow_skipped += 1
+            else:
+                super().__setattr__(a, v)
+                self._shadow[a] = v
+                self.shadow_writes += 1
+        else:
+            super().__setattr__(a, v)
@@ -0,0 +1,278 @@
+''' NumPy model of the axis_kidsim_v3 resonator simulator
+
+The fixed-point datapath is not bit-accurate to the firmware: it was not validated against the RTL
+(not in this repository) or against data captured on hardware, so it is not a test oracle for the board.
+check_fixed_point pins the model itself (register encoding, DDS sequence, IIR response) against changes.
+'''
+import numpy as np
+from scipy.signal import lfilter
+
+from drivers.misc import REGS_DTYPE, TABLE_DTYPE, OUTSEL, compile_resonator_regs
+
+class KidsimModel():
+    """
+    KidsimModel class
+    Offline model of what an AxisKidsimV3 block does to a channelized stream.
+
+    The model is driven by the same register images the driver writes (REGS_DTYPE/TABLE_DTYPE),
+    so it can be used to check register encodings and readout strategies without a board.
+
+    Per lane, the resonator sits on channel punct*L + addr and does:
+
+    * DDS: a phase accumulator of B_DDS bits, with frequency word freq - offset.
+      On a trigger, offset jumps to bval and then decreases by slope every wait+1 samples, for steps steps.
+      After the last step the offset goes back to 0 (rest frequency).
+    * Resonator: the channel is mixed down by the DDS, filtered by the pole-zero IIR
+      y[n] = g*(v[n] - c0*v[n-1]) + c1*y[n-1] (c0, c1, g are B_COEF-bit fractions) and mixed back up.
+    * Output select: resonator, dds (full scale), input or zero.
+
+    Channels without a resonator are passed through.
+
+    Two datapaths are available:
+
+    * float (default): quantized coefficients and DDS words, float arithmetic; fast (lfilter per lane).
+    * fixed_point: integer datapath with B_COEF-bit quantized DDS samples and coefficients and
+      flooring shifts after every product; the IIR recursion runs sample by sample,
+      vectorized across lanes. This is an approximation of the firmware quantization,
+      not validated against the RTL or against data captured on hardware.
+    """
+    def __init__(self, L=8, NCH=256, fs_dds=1000, B_DDS=16, B_COEF=16):
+        """
+        Parameters
+        ----------
+        L : int
+            number of lanes
+        NCH : int
+            number of PFB channels
+        fs_dds : float
+            DDS sampling frequency (channel sampling frequency), in Hz
+        B_DDS : int
+            DDS bits
+        B_COEF : int
+            coefficient/gain bits
+        """
+        self.L      = L
+        self.NCH    = NCH
+        self.NPUNCT = int(NCH/L)
+        self.FS_DDS = fs_dds
+        self.B_DDS  = B_DDS
+        self.B_COEF = B_COEF
+
+        # Resonator table, same layout as AxisKidsimV3.table.
+        self.table = np.zeros(L, dtype=TABLE_DTYPE)
+
+        self.reset()
+
+    @classmethod
+    def from_kidsim(cls, kidsim):
+        """Model of a kidsim block, loaded with its resonator table.
+        """
+        model = cls(kidsim.L, kidsim.NCH, kidsim.FS_DDS, kidsim.B_DDS, kidsim.B_COEF)
+        model.load(kidsim.snapshot())
+        return model
+
+    def load(self, regs):
+        """Load register images (REGS_DTYPE or TABLE_DTYPE array), one lane per row.
+        """
+        regs = np.atleast_1d(regs)
+        if 'valid' in regs.dtype.names:
+            regs = regs[regs['valid']]
+        lanes = regs['addr']
+        for name in REGS_DTYPE.names:
+            self.table[name][lanes] = regs[name]
+        self.table['valid'][lanes] = True
+        self.reset()
+
+    def reset(self):
+        """Clear the DDS, IIR and sweep state.
+        """
+        self.n       = 0
+        self.phase   = np.zeros(self.L, dtype=np.int64)
+        self.v_prev  = np.zeros(self.L, dtype=complex)
+        self.y_prev  = np.zeros(self.L, dtype=complex)
+        self.t_trig  = np.full(self.L, -2**62, dtype=np.int64)
+
+    def process(self, x, trigger=None, fixed_point=False):
+        """Process a block of the channelized stream.
+
+        Consecutive calls continue the stream (DDS phase, IIR state and sweeps carry over).
+
+        Parameters
+        ----------
+        x : array of complex
+            input samples, shape (nsamp, NCH); integer-valued for the fixed-point datapath
+        trigger : array of int, or dict
+            sample indices (relative to this block) where the sweeps start;
+            a dict {lane : indices} triggers lanes separately
+        fixed_point : bool
+            use the integer datapath (an approximation of the firmware quantization)
+
+        Returns
+        -------
+        numpy.ndarray
+            output samples, shape (nsamp, NCH)
+        """
+        x = np.asarray(x)
+        nsamp = x.shape[0]
+        if x.shape[1] != self.NCH:
+            raise ValueError("Input has %d channels, expected %d" % (x.shape[1], self.NCH))
+        y = x.astype(complex)
+
+        lanes = np.flatnonzero(self.table['valid'])
+        if len(lanes) > 0 and nsamp > 0:
+            entries  = self.table[lanes]
+            channels = entries['punct']*self.L + entries['addr']
+            dds = self._dds(lanes, nsamp, trigger, fixed_point)
+            xin = x[:, channels]
+
+            if fixed_point:
+                res = self._resonator_fixed(lanes, xin, dds)
+            else:
+                res = self._resonator_float(lanes, xin, dds)
+            full = 2**(self.B_COEF-1) - 1
+
+            # Output selection.
+            out = np.zeros_like(res)
+            outsel = entries['outsel']
+            out[:, outsel == OUTSEL['resonator']] = res[:, outsel == OUTSEL['resonator']]
+            out[:, outsel == OUTSEL['dds']]       = full*dds[:, outsel == OUTSEL['dds']]
+            out[:, outsel == OUTSEL['input']]     = xin[:, outsel == OUTSEL['input']]
+            y[:, channels] = out
+
+        self.n += nsamp
+        return y
+
+    def _dds(self, lanes, nsamp, trigger, fixed_point):
+        # Unit amplitude; quantized to B_COEF bits for the fixed-point datapath.
+        dds = np.exp(2j*np.pi*self._phase(lanes, nsamp, trigger)/2**self.B_DDS)
+        if fixed_point:
+            full = 2**(self.B_COEF-1) - 1
+            dds = (np.round(dds.real*full) + 1j*np.round(dds.imag*full))/full
+        return dds
+
+    def _phase(self, lanes, nsamp, trigger):
+        # Frequency words, shape (nsamp, lanes).
+        n = self.n + np.arange(nsamp)
+        fword = np.empty((nsamp, len(lanes)), dtype=np.int64)
+        for i, lane in enumerate(lanes):
+            e = self.table[lane]
+
+            # Most recent trigger for every sample.
+            if isinstance(trigger, dict):
+                trig = trigger.get(lane, [])
+            else:
+                trig = [] if trigger is None else trigger
+            trig = self.n + np.sort(np.asarray(trig, dtype=np.int64))
+            trig = np.concatenate([[self.t_trig[lane]], trig])
+            t0 = trig[np.searchsorted(trig, n, side='right') - 1]
+            self.t_trig[lane] = trig[-1]
+
+            # Sweep offset.
+            k = (n - t0)//(e['wait']+1)
+            offset = np.where(k < e['steps'], e['bval'] - e['slope']*k, 0)
+            fword[:, i] = e['freq'] - offset
+
+        # Phase accumulator (phase of sample n excludes its own word).
+        mod = 2**self.B_DDS
+        phase = (self.phase[lanes] + np.cumsum(fword, axis=0) - fword) % mod
+        self.phase[lanes] = (self.phase[lanes] + fword.sum(axis=0)) % mod
+        return phase
+
+    def _coefs(self, lanes):
+        scale = 2**(self.B_COEF-1)
+        e = self.table[lanes]
+        return e['c0']/scale, e['c1']/scale, e['g']/scale
+
+    def _resonator_float(self, lanes, xin, dds):
+        c0, c1, g = self._coefs(lanes)
+        v = xin*np.conj(dds)
+        v_prev = np.vstack([self.v_prev[lanes], v[:-1]])
+        u = g*(v - c0*v_prev)
+        r = np.empty_like(u)
+        for i, lane in enumerate(lanes):
+            r[:, i], _ = lfilter([1], [1, -c1[i]], u[:, i], zi=[c1[i]*self.y_prev[lane]])
+            self.y_prev[lane] = r[-1, i]
+        self.v_prev[lanes] = v[-1]
+        return r*dds
+
+    def _resonator_fixed(self, lanes, xin, dds):
+        shift = self.B_COEF-1
+        e = self.table[lanes]
+        c0, c1, g = e['c0'], e['c1'], e['g']
+
+        def qmul(a_re, a_im, b_re, b_im):
+            # Complex integer product, scaled back by 2**shift (floor).
+            return (a_re*b_re - a_im*b_im) >> shift, (a_re*b_im + a_im*b_re) >> shift
+
+        x_re, x_im = np.round(xin.real).astype(np.int64), np.round(xin.imag).astype(np.int64)
+        full = 2**(self.B_COEF-1) - 1
+        d_re, d_im = np.round(dds.real*full).astype(np.int64), np.round(dds.imag*full).astype(np.int64)
+
+        # Mix down.
+        v_re, v_im = qmul(x_re, x_im, d_re, -d_im)
+
+        # Zero and gain.
+        vp_re = np.vstack([self.v_prev[lanes].real.astype(np.int64), v_re[:-1]])
+        vp_im = np.vstack([self.v_prev[lanes].imag.astype(np.int64), v_im[:-1]])
+        w_re = v_re - ((c0*vp_re) >> shift)
+        w_im = v_im - ((c0*vp_im) >> shift)
+        u_re, u_im = (g*w_re) >> shift, (g*w_im) >> shift
+
+        # Pole (recursive).
+        y_re = np.empty_like(u_re)
+        y_im = np.empty_like(u_im)
+        p_re = self.y_prev[lanes].real.astype(np.int64)
+        p_im = self.y_prev[lanes].imag.astype(np.int64)
+        for k in range(len(u_re)):
+            p_re = u_re[k] + ((c1*p_re) >> shift)
+            p_im = u_im[k] + ((c1*p_im) >> shift)
+            y_re[k] = p_re
+            y_im[k] = p_im
+        self.v_prev[lanes] = v_re[-1] + 1j*v_im[-1]
+        self.y_prev[lanes] = p_re + 1j*p_im
+
+        # Mix up.
+        r_re, r_im = qmul(y_re, y_im, d_re, d_im)
+        return r_re + 1j*r_im
+
+def check_fixed_point():
+    """Regression check of the fixed-point datapath, on a 4x2-like block (8 lanes, 256 channels,
+    19.2 MHz DDS), with register images from compile_resonator_regs:
+
+    * a 0.3 MHz DDS with a 4-step, 0.15 MHz sweep (wait 1) triggered at sample 2: register image,
+      phase sequence, and the quantized DDS samples (outsel 'dds');
+    * the IIR (c0=0.9, c1=0.8, DDS at 0 Hz) response to an impulse: recorded output samples.
+
+    Raises AssertionError if the model no longer gives these values.
+    """
+    fs, ch = 19.2e6, 10
+
+    # DDS: df = fs/2**16, so freq = 0.3 MHz/df = 1024, bval = 512, slope = bval/4 = 128,
+    # wait = trunc(0.42 us*fs/4) - 1 = 1; g = round((1+c1)/(1+c0)*2**15).
+    regs, _, _ = compile_resonator_regs(ch, 0.3, 0.15, 0.42, 4, 0.9, 0.8, 'dds', 8, fs)
+    assert regs.tolist() == (512, 128, 4, 1, 1024, 29491, 26214, 31043, OUTSEL['dds'], 1, 2), regs
+    model = KidsimModel(fs_dds=fs)
+    model.load(regs)
+    lane = np.array([regs['addr']])
+    # Words: freq before the trigger, then freq - (bval - slope*k) for 2 samples per step k, then freq.
+    words = np.array([1024]*2 + [512]*2 + [640]*2 + [768]*2 + [896]*2 + [1024]*2)
+    phase = np.cumsum(words) - words
+    assert np.array_equal(model._phase(lane, 12, [2])[:, 0], phase)
+    model.reset()
+    dds = np.exp(2j*np.pi*phase/2**16)*(2**15 - 1)
+    y = model.process(np.zeros((12, model.NCH)), trigger=[2], fixed_point=True)[:, ch]
+    assert np.array_equal(y, np.round(dds.real) + 1j*np.round(dds.imag)), y
+
+    # IIR impulse response (first sample: 2**14 mixed by the 32767 DDS sample, floor: 16383;
+    # times g: 15520; mixed back up: 15519), recorded from this model.
+    regs, _, _ = compile_resonator_regs(ch, 0.0, 0.0, 0.42, 4, 0.9, 0.8, 'resonator', 8, fs)
+    model = KidsimModel(fs_dds=fs)
+    model.load(regs)
+    x = np.zeros((10, model.NCH))
+    x[0, ch] = 2**14
+    y = model.process(x, fixed_point=True)[:, ch]
+    assert np.array_equal(y, [15519, -1553, -1243, -995, -796, -637, -510, -408, -327, -262]), y
+
+if __name__ == '__main__':
+    check_fixed_point()
+    print("fixed-point datapath: ok")
@@ -0,0 +1,210 @@
+''' Software polyphase filter banks, for re-channelizing captured data on the host '''
+import numpy as np
+
+from drivers.pfb import pfb_channel_centers, pfb_freq2ch, pfb_ch2freq
+
+def pfb_prototype(N, taps=8, beta=5.0):
+    """Prototype low-pass filter of an N-channel PFB, normalized to unit DC gain.
+
+    The response is a root raised cosine (full roll-off) reaching zero at the channel spacing fc,
+    so the squared responses of adjacent channels add up to one: analysis followed by synthesis
+    with the same prototype reconstructs the input. The impulse response is Kaiser-windowed to taps*N samples.
+    """
+    L = taps*N
+    f = np.fft.fftfreq(L)
+    H = np.where(np.abs(f) < 1/N, np.cos(np.pi*f*N/2), 0)
+    h = np.fft.fftshift(np.fft.ifft(H).real)*np.kaiser(L, beta)
+    return h/h.sum()
+
+class PfbAnalysisModel():
+    """
+    PfbAnalysisModel class
+    Host-side version of AxisPfbAnalysis: N channels spaced by fc = fs/N, sampled at fb = 2*fs/N.
+
+    Channel k is centered at k*fc (channels N/2 and above are the negative frequencies),
+    as in the freq2ch/ch2freq convention of the PFB drivers.
+    Every channel is mixed down to baseband with an absolute phase reference, so a tone at
+    a channel center comes out as a constant.
+
+    Data are processed in chunks of any length; only the filter history is kept between calls.
+    """
+    def __init__(self, N=256, fs=1.0, taps=8, beta=5.0):
+        """
+        Parameters
+        ----------
+        N : int
+            number of channels
+        fs : float
+            input sampling frequency
+        taps : int
+            prototype filter length, in multiples of N
+        beta : float
+            Kaiser window parameter of the prototype filter
+        """
+        self.N    = N
+        self.D    = N//2
+        self.taps = taps
+
+        # Prototype, time-reversed and split into 2*taps blocks of D samples.
+        self.h  = pfb_prototype(N, taps, beta)
+        self.w2 = self.h[::-1].reshape(2*taps, self.D).astype(np.float32)
+
+        # Phase correction of frames starting at an odd multiple of D.
+        self.sign = ((-1)**np.arange(N)).astype(np.complex64)
+
+        # Frequencies.
+        self.dict = {'N' : N}
+        self.dict['freq'] = {'fs' : fs, 'fc' : fs/N, 'fb' : fs/(N/2)}
+        self.dict['freq']['centers'] = pfb_channel_centers(fs, N)
+
+        self.reset()
+
+    def reset(self):
+        self.buf = np.zeros(0, dtype=np.complex64)
+        self.m   = 0
+
+    def freq2ch(self, f, out_of_range='raise'):
+        return pfb_freq2ch(f, self.dict['freq']['fs'], self.N, out_of_range)
+
+    def ch2freq(self, ch, out_of_range='raise'):
+        return pfb_ch2freq(ch, self.dict['freq']['centers'], out_of_range)
+
+    def push(self, x):
+        """Channelize the next chunk of the input stream.
+
+        Parameters
+        ----------
+        x : array
+            complex samples, or (n, 2) array of I/Q values
+
+        Returns
+        -------
+        numpy.ndarray
+            new output frames, shape (nframes, N), complex64
+        """
+        x = np.asarray(x)
+        if x.ndim == 2:
+            x = x[:, 0] + 1j*x[:, 1]
+        buf = np.concatenate([self.buf, x.astype(np.complex64)])
+
+        # Complete frames: frame m covers blocks m .. m+2*taps-1.
+        nblocks = len(buf)//self.D
+        nframes = nblocks - 2*self.taps + 1
+        if nframes <= 0:
+            self.buf = buf
+            return np.zeros((0, self.N), dtype=np.complex64)
+        blocks = buf[:nblocks*self.D].reshape(nblocks, self.D)
+
+        # Weight and fold into N samples.
+        u = np.zeros((nframes, self.N), dtype=np.complex64)
+        tmp = np.empty((nframes, self.D), dtype=np.complex64)
+        for q in range(2*self.taps):
+            half = (q % 2)*self.D
+            np.multiply(blocks[q:q+nframes], self.w2[q], out=tmp)
+            u[:, half:half+self.D] += tmp
+
+        X = np.fft.fft(u, axis=1)
+        odd = (self.m + np.arange(nframes)) % 2 == 1
+        X[odd] *= self.sign
+
+        self.m  += nframes
+        self.buf = buf[nframes*self.D:]
+        return X
+
+    def process(self, chunks):
+        """Generator: channelize a stream given as an iterable of chunks, yielding output frames.
+        Memory use is bounded by the chunk size.
+        """
+        for x in chunks:
+            X = self.push(x)
+            if len(X) > 0:
+                yield X
+
+class PfbSynthesisModel():
+    """
+    PfbSynthesisModel class
+    Host-side version of AxisPfbSynthesis: the inverse of PfbAnalysisModel (same channel convention).
+    """
+    def __init__(self, N=256, fs=1.0, taps=8, beta=5.0):
+        """
+        Parameters
+        ----------
+        N : int
+            number of channels
+        fs : float
+            output sampling frequency
+        taps : int
+            prototype filter length, in multiples of N
+        beta : float
+            Kaiser window parameter of the prototype filter
+        """
+        self.N    = N
+        self.D    = N//2
+        self.taps = taps
+
+        # Prototype split into 2*taps blocks of D samples, with the overlap-add gain.
+        self.h  = pfb_prototype(N, taps, beta)
+        self.g2 = (self.D*self.h).reshape(2*taps, self.D).astype(np.float32)
+
+        self.sign = ((-1)**np.arange(N)).astype(np.complex64)
+
+        # Frequencies.
+        self.dict = {'N' : N}
+        self.dict['freq'] = {'fs' : fs, 'fc' : fs/N, 'fb' : fs/(N/2)}
+        self.dict['freq']['centers'] = pfb_channel_centers(fs, N)
+
+        self.reset()
+
+    def reset(self):
+        self.acc = np.zeros((2*self.taps-1, self.D), dtype=np.complex64)
+        self.m   = 0
+
+    def freq2ch(self, f, out_of_range='raise'):
+        return pfb_freq2ch(f, self.dict['freq']['fs'], self.N, out_of_range)
+
+    def ch2freq(self, ch, out_of_range='raise'):
+        return pfb_ch2freq(ch, self.dict['freq']['centers'], out_of_range)
+
+    def push(self, X):
+        """Synthesize the next frames.
+
+        Parameters
+        ----------
+        X : array
+            channel frames, shape (nframes, N)
+
+        Returns
+        -------
+        numpy.ndarray
+            nframes*N/2 new output samples, complex64
+        """
+        X = np.asarray(X, dtype=np.complex64)
+        nframes = len(X)
+        if nframes == 0:
+            return np.zeros(0, dtype=np.complex64)
+
+        X = X.copy()
+        odd = (self.m + np.arange(nframes)) % 2 == 1
+        X[odd] *= self.sign
+        v = (np.fft.ifft(X, axis=1)*self.N).astype(np.complex64)
+
+        # Overlap-add: frame m contributes to blocks m .. m+2*taps-1.
+        acc = np.zeros((nframes + 2*self.taps - 1, self.D), dtype=np.complex64)
+        acc[:2*self.taps-1] = self.acc
+        tmp = np.empty((nframes, self.D), dtype=np.complex64)
+        for q in range(2*self.taps):
+            half = (q % 2)*self.D
+            np.multiply(v[:, half:half+self.D], self.g2[q], out=tmp)
+            acc[q:q+nframes] += tmp
+
+        self.m  += nframes
+        self.acc = acc[nframes:]
+        return acc[:nframes].reshape(-1)
+
+    def process(self, frames):
+        """Generator: synthesize a stream given as an iterable of frame blocks, yielding output samples.
+        """
+        for X in frames:
+            y = self.push(X)
+            if len(y) > 0:
+                yield y
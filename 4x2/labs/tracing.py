@@ -0,0 +1,201 @@
+''' Opt-in timing instrumentation: nanosecond spans of the phases of an experiment, in a ring buffer '''
+import json
+import time
+import functools
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+# One recorded span: name and category indices, start time and duration (ns), thread.
+SPAN_DTYPE = np.dtype([('name' , np.int32),
+                       ('cat'  , np.int32),
+                       ('start', np.int64),
+                       ('dur'  , np.int64),
+                       ('tid'  , np.int64)])
+
+class Tracer():
+    """
+    Tracer class
+    Records the time spent in the phases of an experiment (resonator configuration, register writes,
+    program construction, run, readback, host analysis) as spans, in a ring buffer of fixed size:
+    once it is full, the oldest spans are overwritten.
+
+    Spans are recorded by the methods wrapped with patch (or instrument), and by span blocks::
+
+        tracer = soc.enable_tracing()
+        ...                                 # run the sweep
+        with tracer.span('analysis', 'host'):
+            hist_process(...)
+        print(tracer.report())
+        tracer.save_chrome_trace('sweep.json')  # open in chrome://tracing or Perfetto
+    """
+    def __init__(self, size=1<<16):
+        """
+        Parameters
+        ----------
+        size : int
+            number of spans kept
+        """
+        self.size    = size
+        self.spans   = np.zeros(size, dtype=SPAN_DTYPE)
+        self.n       = 0
+        self.names   = []
+        self.ids     = {}
+        self.lock    = threading.Lock()
+        self.patches = []
+        self.t0      = time.perf_counter_ns()
+
+    def _id(self, name):
+        i = self.ids.get(name)
+        if i is None:
+            with self.lock:
+                i = self.ids.setdefault(name, len(self.names))
+                if i == len(self.names):
+                    self.names.append(name)
+        return i
+
+    def record(self, name, cat, start, dur):
+        """Record a span (start and duration in ns, start from time.perf_counter_ns).
+        """
+        name, cat = self._id(name), self._id(cat)
+        with self.lock:
+            self.spans[self.n % self.size] = (name, cat, start, dur, threading.get_ident())
+            self.n += 1
+
+    @contextmanager
+    def span(self, name, cat='host'):
+        """Context manager: record the time spent in the block.
+        """
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.record(name, cat, start, time.perf_counter_ns() - start)
+
+    def wrap(self, fn, name, cat):
+        """fn, recording a span for each call. With name None, methods are named after the class
+        of their object (first argument) and fn.
+        """
+        tracer = self
+        @functools.wraps(fn)
+        def traced(*args, **kwargs):
+            start = time.perf_counter_ns()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                dur = time.perf_counter_ns() - start
+                tracer.record(name or "%s.%s" % (type(args[0]).__name__, fn.__name__), cat, start, dur)
+        traced.traced = fn
+        return traced
+
+    def patch(self, obj, attr, cat, name=None):
+        """Replace method attr of obj (an object, or a class to trace all its instances) with a traced version.
+        Undone by unpatch.
+        """
+        fn = getattr(obj, attr)
+        if isinstance(obj, type):
+            own = attr in vars(obj)
+            fn = vars(obj)[attr] if own else fn
+        else:
+            own = attr in getattr(obj, '__dict__', {})
+            if name is None:
+                name = "%s.%s" % (type(obj).__name__, attr)
+        if hasattr(fn, 'traced'):
+            return
+        setattr(obj, attr, self.wrap(fn, name, cat))
+        self.patches.append((obj, attr, fn if own else None))
+
+    def unpatch(self):
+        """Restore all the patched methods.
+        """
+        for obj, attr, fn in reversed(self.patches):
+            if fn is None:
+                delattr(obj, attr)
+            else:
+                setattr(obj, attr, fn)
+        self.patches = []
+
+    def instrument(self, soc, programs=()):
+        """Trace the resonator configuration (config_resonator, config_resonators), the register writes of
+        the PFB and kidsim blocks of a QickTrainingSoc, and the construction ('compile'), acquire and
+        acquire_decimated ('run') and get_raw ('readback') of the program classes.
+        """
+        for attr in ['config_resonator', 'config_resonators']:
+            self.patch(soc, attr, 'config')
+        for block in soc._shadow_blocks():
+            for attr in ['qout', '_write_registers', 'write_resonators']:
+                if hasattr(block, attr):
+                    self.patch(block, attr, 'registers', name="%s.%s" % (block.fullpath, attr.lstrip('_')))
+        for cls in programs:
+            for attr, cat in [('__init__', 'compile'), ('acquire', 'run'), ('acquire_decimated', 'run'), ('get_raw', 'readback')]:
+                if hasattr(cls, attr):
+                    self.patch(cls, attr, cat)
+
+    def records(self):
+        """Recorded spans (SPAN_DTYPE array), oldest first.
+        """
+        with self.lock:
+            if self.n <= self.size:
+                return self.spans[:self.n].copy()
+            i = self.n % self.size
+            return np.concatenate([self.spans[i:], self.spans[:i]])
+
+    @property
+    def dropped(self):
+        """Number of spans overwritten.
+        """
+        return max(0, self.n - self.size)
+
+    def summary(self):
+        """Statistics of the recorded spans, by name.
+
+        Returns
+        -------
+        dict
+            name : {cat, count, total (ms), mean (us), min (us), max (us)}
+        """
+        spans = self.records()
+        stats = {}
+        for i in np.unique(spans['name']):
+            sel = spans[spans['name'] == i]
+            dur = sel['dur']
+            stats[self.names[i]] = {'cat'   : self.names[sel['cat'][0]],
+                                    'count' : len(sel),
+                                    'total' : dur.sum()/1e6,
+                                    'mean'  : dur.mean()/1e3,
+                                    'min'   : dur.min()/1e3,
+                                    'max'   : dur.max()/1e3}
+        return stats
+
+    def report(self):
+        """Summary as a table, by decreasing total time.
+        """
+        stats = self.summary()
+        lines = ["%-48s %-10s %8s %12s %12s %12s" % ('name', 'cat', 'count', 'total ms', 'mean us', 'max us')]
+        for name, s in sorted(stats.items(), key=lambda item: -item[1]['total']):
+            lines.append("%-48s %-10s %8d %12.3f %12.2f %12.2f" % (name, s['cat'], s['count'], s['total'], s['mean'], s['max']))
+        if self.dropped:
+            lines.append("(%d older spans dropped)" % (self.dropped))
+        return "\n".join(lines)
+
+    def chrome_trace(self):
+        """Spans in the Chrome trace event format (complete events, times in us from the tracer creation).
+        """
+        events = []
+        for s in self.records():
+            events.append({'name' : self.names[s['name']],
+                           'cat'  : self.names[s['cat']],
+                           'ph'   : 'X',
+                           'ts'   : (int(s['start']) - self.t0)/1e3,
+                           'dur'  : int(s['dur'])/1e3,
+                           'pid'  : 0,
+                           'tid'  : int(s['tid'])})
+        return {'traceEvents' : events, 'displayTimeUnit' : 'ns'}
+
+    def save_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+    def clear(self):
+        with self.lock:
+            self.n = 0
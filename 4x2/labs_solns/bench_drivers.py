@@ -0,0 +1,293 @@
+''' Host-side benchmarks of the training drivers, on the mock MMIO backend '''
+import sys
+import json
+import time
+import logging
+import threading
+import subprocess
+
+from qick_training import *
+from drivers.mock import MockRf, mock_description
+
+class MockTrainingSoc(QickTrainingSoc):
+    """
+    MockTrainingSoc class
+    QickTrainingSoc with resonator simulator chains on the mock backend (no board needed).
+    Register writes go to the MockMMIO of each block, where they are logged.
+    """
+    def __init__(self, L=8, N=256, fs=2457.6, lazy=False, nchains=1):
+        """
+        Parameters
+        ----------
+        L : int
+            number of kidsim lanes
+        N : int
+            number of PFB channels
+        fs : float
+            ADC/DAC sampling frequency, in MHz
+        lazy : bool
+            build the simulator chains on first access (see QickTrainingSoc)
+        nchains : int
+            number of simulator chains (ADC/DAC 0 to nchains-1 of tile 0)
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.lazy = lazy
+        self._cfg = {'adcs' : {}, 'dacs' : {}, 'extra_description' : []}
+        self.rf = MockRf()
+        self.ip_dict = {}
+        self.raw_cache = {}
+
+        for i in range(nchains):
+            adc = dac = '0%d' % (i)
+            self._cfg['adcs'][adc] = {'fs' : fs, 'decimation' : 1, 'index' : [0, i]}
+            self._cfg['dacs'][dac] = {'fs' : fs, 'interpolation' : 1, 'index' : [0, i]}
+
+            # Blocks of one simulator chain.
+            kidsim  = AxisKidsimV3(mock_description('axis_kidsim_v3_%d' % (i), AxisKidsimV3, {'L' : L}))
+            pfb_in  = AxisPfbAnalysis(mock_description('axis_pfba_pr_4x256_v1_%d' % (i), AxisPfbAnalysis, {'N' : N}))
+            pfb_out = AxisPfbSynthesis(mock_description('axis_pfbs_pr_4x256_v1_%d' % (i), AxisPfbSynthesis, {'N' : N}))
+
+            # Connections (normally traced by configure_connections).
+            pfb_in.HAS_ADC     = True
+            pfb_in.HAS_KIDSIM  = True
+            pfb_in.dict['adc'] = {'tile' : '0', 'ch' : str(i), 'id' : adc}
+            pfb_in.dict['kidsim'] = kidsim.fullpath
+            pfb_out.HAS_DAC    = True
+            pfb_out.HAS_KIDSIM = True
+            pfb_out.dict['dac'] = {'tile' : '0', 'ch' : str(i), 'id' : dac}
+            pfb_out.dict['kidsim'] = kidsim.fullpath
+
+            for block in [kidsim, pfb_in, pfb_out]:
+                self.ip_dict[block.fullpath] = {'driver' : type(block)}
+                setattr(self, block.fullpath, block)
+
+        self._timed('map_local', self.map_local)
+        self._timed('map_simu', self.map_simu)
+
+    def _describe_adc(self, adcname):
+        return "ADC %s" % (adcname)
+
+    def _describe_dac(self, dacname):
+        return "DAC %s" % (dacname)
+
+    def mmio_blocks(self):
+        return [getattr(self, key) for key in self.ip_dict]
+
+    def clear_logs(self):
+        for block in self.mmio_blocks():
+            block.mmio.clear_log()
+
+    def raw_shots(self, reps=10000, steps=11, nprog=2, seed=0):
+        """Mock raw readout data: for each of nprog programs, a (reps*steps, 2) int32 array of I/Q
+        values (as returned by get_raw of a one-readout program), within the int16 range.
+        The data are drawn once for each set of arguments.
+        """
+        key = (reps, steps, nprog, seed)
+        if key not in self.raw_cache:
+            rng = np.random.default_rng(seed)
+            self.raw_cache[key] = [np.clip(np.round(rng.normal(1000*i, 3000, (reps*steps, 2))), -32768, 32767).astype(np.int32)
+                                   for i in range(nprog)]
+        return self.raw_cache[key]
+
+    def nwrites(self):
+        """Total number of logged register writes.
+        """
+        return sum(block.mmio.nlog for block in self.mmio_blocks())
+
+def bench(soc, name, fn, n=1000):
+    """Time n calls of fn, and count the register writes they do.
+    """
+    fn()
+    soc.clear_logs()
+    t0 = time.perf_counter()
+    for i in range(n):
+        fn()
+    dt = time.perf_counter() - t0
+    return {'name'        : name,
+            'calls_per_s' : n/dt,
+            'us_per_call' : dt/n*1e6,
+            'writes_per_call' : soc.nwrites()/n}
+
+def bench_startup(name, fn, n=100):
+    """Time n calls of fn (a constructor).
+    """
+    t0 = time.perf_counter()
+    for i in range(n):
+        fn()
+    dt = time.perf_counter() - t0
+    return {'name'        : name,
+            'calls_per_s' : n/dt,
+            'us_per_call' : dt/n*1e6,
+            'writes_per_call' : 0.0}
+
+def run_benchmarks(n=1000):
+    results = []
+    results.append(bench_startup('MockTrainingSoc()', lambda: MockTrainingSoc(), n))
+    results.append(bench_startup('MockTrainingSoc(lazy=True)', lambda: MockTrainingSoc(lazy=True), n))
+
+    soc = MockTrainingSoc()
+    simu = soc.simu[0]
+    kidsim = getattr(soc, simu.analysis.dict['chain']['kidsim'])
+
+    results.append(bench(soc, 'AxisKidsimV3.set_resonator',
+                         lambda: kidsim.set_resonator({'channel' : 17, 'sweep_freq' : 1.0, 'sweep_time' : 10, 'nstep' : 1}), n))
+    results.append(bench(soc, 'AxisKidsimV3.setall',
+                         lambda: kidsim.setall({'sel' : 'input'}), n))
+    results.append(bench(soc, 'SimuChain.set_resonator',
+                         lambda: simu.set_resonator({'sel' : 'resonator', 'freq' : 500.0, 'sweep_freq' : 1.0, 'sweep_time' : 10, 'nstep' : 1}), n))
+    results.append(bench(soc, 'QickTrainingSoc.config_resonator',
+                         lambda: soc.config_resonator(f=500.0), n))
+    results.append(bench(soc, 'QickTrainingSoc.config_resonator(force)',
+                         lambda: soc.config_resonator(f=500.0, force=True), n))
+    table = [{'f' : 500.0 + 9.6*k} for k in range(kidsim.L)]
+    results.append(bench(soc, 'QickTrainingSoc.config_resonators(L)',
+                         lambda: soc.config_resonators(table), n))
+
+    # Four chains, serial and with a thread pool.
+    soc = MockTrainingSoc(nchains=4)
+    table = [{'f' : 500.0 + 9.6*k, 'chain' : c} for c in range(4) for k in range(kidsim.L)]
+    results.append(bench(soc, 'config_resonators(4 chains)',
+                         lambda: soc.config_resonators(table), n))
+    results.append(bench(soc, 'config_resonators(4 chains, 4 workers)',
+                         lambda: soc.config_resonators(table, workers=4), n))
+    results[-1]['speedup'] = soc.config_timing['speedup']
+    return results
+
+def bench_pyro(n=16, ns_port=0):
+    """Network round trips and time of n config_resonator calls to a MockTrainingSoc served with Pyro4
+    on localhost (name server and daemon as started by qick.pyro), one call at a time and batched.
+    """
+    import Pyro4
+    import Pyro4.naming
+    from pyro_batch import BatchProxy
+
+    # Same settings as qick.pyro.
+    Pyro4.config.REQUIRE_EXPOSE = False
+    Pyro4.config.SERIALIZER = "pickle"
+    Pyro4.config.SERIALIZERS_ACCEPTED = set(['pickle'])
+    Pyro4.config.PICKLE_PROTOCOL_VERSION = 4
+
+    class CountingProxy(Pyro4.Proxy):
+        # Counts the remote invocations (round trips) of all its instances.
+        round_trips = 0
+        def _pyroInvoke(self, *args, **kwargs):
+            CountingProxy.round_trips += 1
+            return super()._pyroInvoke(*args, **kwargs)
+
+    ns_uri, ns_daemon, bc_server = Pyro4.naming.startNS(host='localhost', port=ns_port, enableBroadcast=False)
+    daemon = Pyro4.Daemon(host='localhost')
+    threads = [threading.Thread(target=d.requestLoop, daemon=True) for d in [ns_daemon, daemon]]
+    for t in threads:
+        t.start()
+    try:
+        ns = Pyro4.locateNS(host='localhost', port=ns_uri.port)
+        ns.register('myqick', daemon.register(MockTrainingSoc(nchains=4)))
+        soc = CountingProxy(ns.lookup('myqick'))
+        soc._pyroBind()
+
+        def direct():
+            for k in range(n):
+                soc.config_resonator(simu_ch=k%4, f=500.0+9.6*(k//4))
+
+        def batched():
+            with BatchProxy(soc) as batch:
+                for k in range(n):
+                    batch.config_resonator(simu_ch=k%4, f=500.0+9.6*(k//4))
+
+        results = []
+        for name, fn in [('config_resonator x%d' % (n), direct), ('config_resonator x%d (batch)' % (n), batched)]:
+            CountingProxy.round_trips = 0
+            t0 = time.perf_counter()
+            fn()
+            results.append({'name'        : name,
+                            'round_trips' : CountingProxy.round_trips,
+                            'ms'          : (time.perf_counter() - t0)*1e3})
+        soc._pyroRelease()
+    finally:
+        daemon.shutdown()
+        ns_daemon.shutdown()
+    return results
+
+def bench_transport(reps=10000, steps=11, nprog=2, n=5, ns_port=0):
+    """Throughput of the raw data of a readout sweep (nprog programs of reps*steps shots), sent by a
+    MockTrainingSoc served with Pyro4 on localhost: plain (arrays pickled by Pyro) and as PackedArray.
+    """
+    import Pyro4
+    import Pyro4.naming
+    import pickle
+    from pyro_batch import PackedProxy, pack_arrays
+
+    # Same settings as qick.pyro.
+    Pyro4.config.REQUIRE_EXPOSE = False
+    Pyro4.config.SERIALIZER = "pickle"
+    Pyro4.config.SERIALIZERS_ACCEPTED = set(['pickle'])
+    Pyro4.config.PICKLE_PROTOCOL_VERSION = 4
+
+    ns_uri, ns_daemon, bc_server = Pyro4.naming.startNS(host='localhost', port=ns_port, enableBroadcast=False)
+    daemon = Pyro4.Daemon(host='localhost')
+    threads = [threading.Thread(target=d.requestLoop, daemon=True) for d in [ns_daemon, daemon]]
+    for t in threads:
+        t.start()
+    try:
+        ns = Pyro4.locateNS(host='localhost', port=ns_uri.port)
+        local = MockTrainingSoc()
+        ns.register('myqick', daemon.register(local))
+        soc = Pyro4.Proxy(ns.lookup('myqick'))
+        soc._pyroBind()
+
+        ref = local.raw_shots(reps, steps, nprog)
+        nbytes = sum(arr.nbytes for arr in ref)
+        modes = [('pickle', None),
+                 ('packed', {}),
+                 ('packed int16', {'dtype' : np.int16}),
+                 ('packed float32', {'dtype' : np.float32}),
+                 ('packed int16 crc32', {'dtype' : np.int16, 'checksum' : True}),
+                 ('packed int16 zlib', {'dtype' : np.int16, 'compress' : 'zlib'})]
+        results = []
+        for name, pack in modes:
+            proxy = soc if pack is None else PackedProxy(soc, **pack)
+            raw = proxy.raw_shots(reps, steps, nprog)
+            assert all(np.array_equal(a, b) and a.flags.writeable for a, b in zip(raw, ref))
+            t0 = time.perf_counter()
+            for i in range(n):
+                proxy.raw_shots(reps, steps, nprog)
+            dt = (time.perf_counter() - t0)/n
+            wire = len(pickle.dumps(ref if pack is None else pack_arrays(ref, **pack), protocol=4))
+            results.append({'name'      : name,
+                            'ms'        : dt*1e3,
+                            'MB_per_s'  : nbytes/dt/1e6,
+                            'wire_MB'   : wire/1e6})
+        soc._pyroRelease()
+    finally:
+        daemon.shutdown()
+        ns_daemon.shutdown()
+    return results
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+
+    results = run_benchmarks(n)
+    for r in results:
+        print("%-36s %12.0f calls/s %10.2f us/call %8.1f writes/call" % (r['name'], r['calls_per_s'], r['us_per_call'], r['writes_per_call']))
+
+    try:
+        pyro = bench_pyro()
+    except ImportError:
+        pyro = []
+    for r in pyro:
+        print("%-36s %12d round trips %10.2f ms" % (r['name'], r['round_trips'], r['ms']))
+
+    try:
+        transport = bench_transport()
+    except ImportError:
+        transport = []
+    for r in transport:
+        print("%-36s %12.1f MB/s %10.2f ms %8.2f MB sent" % (r['name'], r['MB_per_s'], r['ms'], r['wire_MB']))
+    print(json.dumps({'commit' : commit, 'n' : n, 'results' : results, 'pyro' : pyro, 'transport' : transport}))
+
+if __name__ == '__main__':
+    main()
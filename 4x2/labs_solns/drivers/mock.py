@@ -0,0 +1,105 @@
+import time
+import logging
+import numpy as np
+
+# One logged register write: time (ns), register index, value.
+LOG_DTYPE = np.dtype([('t'    , np.int64),
+                      ('index', np.int32),
+                      ('value', np.uint32)])
+
+class MockMMIO():
+    """
+    MockMMIO class
+    Stand-in for pynq.MMIO: holds the register values and logs every write with a timestamp.
+    """
+    def __init__(self, nregs=64, log_size=1<<16):
+        self.regs = np.zeros(nregs, dtype=np.uint32)
+        self._log = np.zeros(log_size, dtype=LOG_DTYPE)
+        self.nlog = 0
+
+        # SocIp accesses registers through mmio.array.
+        self.array = self
+
+    def __setitem__(self, index, value):
+        if self.nlog == len(self._log):
+            self._log = np.concatenate([self._log, np.zeros_like(self._log)])
+        value = int(value) & 0xffffffff
+        self._log[self.nlog] = (time.perf_counter_ns(), index, value)
+        self.nlog += 1
+        self.regs[index] = value
+
+    def __getitem__(self, index):
+        return self.regs[index]
+
+    def write(self, offset, value):
+        self[offset//4] = value
+
+    def read(self, offset):
+        return int(self[offset//4])
+
+    @property
+    def log(self):
+        """Logged writes (LOG_DTYPE array), oldest first.
+        """
+        return self._log[:self.nlog]
+
+    def clear_log(self):
+        self.nlog = 0
+
+class SocIp():
+    """
+    SocIp class
+    Stand-in for qick.qick.SocIp when pynq is not available: registers live in a MockMMIO.
+    """
+    REGISTERS = {}
+
+    def __init__(self, description):
+        self.mmio = MockMMIO()
+        self.fullpath = description['fullpath']
+        self.type = description['type'].split(':')[-2]
+        self.logger = logging.getLogger(self.type)
+
+    def __setattr__(self, a, v):
+        try:
+            index = self.REGISTERS[a]
+            self.mmio.array[index] = v
+        except KeyError:
+            super().__setattr__(a, v)
+
+    def __getattr__(self, a):
+        try:
+            index = self.REGISTERS[a]
+            return self.mmio.array[index]
+        except KeyError:
+            return super().__getattribute__(a)
+
+class QickSoc():
+    """
+    QickSoc class
+    Placeholder for qick.qick.QickSoc when pynq is not available.
+    """
+    def __init__(self, *args, **kwargs):
+        raise RuntimeError("QickSoc needs pynq and a board; use the mock backend (bench_drivers.MockTrainingSoc) instead")
+
+def mock_description(name, driver, parameters):
+    """IP description for building a driver on the mock backend.
+    """
+    return {'fullpath' : name, 'type' : driver.bindto[0], 'parameters' : parameters}
+
+class MockRfBlock():
+    def __init__(self):
+        self.MixerSettings = {'MixerMode' : 1, 'MixerType' : 2, 'EventSource' : 2}
+        self.NyquistZone = 1
+
+class MockRfTile():
+    def __init__(self, nblocks):
+        self.blocks = [MockRfBlock() for i in range(nblocks)]
+
+class MockRf():
+    """
+    MockRf class
+    Stand-in for the RF data converter: mixer settings and Nyquist zones only.
+    """
+    def __init__(self, ntiles=4, nblocks=4):
+        self.adc_tiles = [MockRfTile(nblocks) for i in range(ntiles)]
+        self.dac_tiles = [MockRfTile(nblocks) for i in range(ntiles)]
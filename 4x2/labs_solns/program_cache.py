@@ -0,0 +1,307 @@
+''' Content-addressed cache of compiled QICK programs '''
+import os
+import io
+import sys
+import types
+import pickle
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+def _version(module):
+    # Version of the installed package (e.g. qick, numpy) of a module, None for local code.
+    return getattr(sys.modules.get((module or '').split('.')[0]), '__version__', None)
+
+def _library(obj):
+    # Version of the installed package that defines obj.
+    return _version(getattr(obj, '__module__', None))
+
+def _global_names(code):
+    # Names a code object (and the functions, comprehensions, ... defined in it) looks up.
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _global_names(const)
+    return names
+
+def _canon_globals(fn, h, seen, memo):
+    # Module globals used by fn: code (functions, classes, modules) and values (constants, tables) are hashed;
+    # other objects only by their class, as their state (e.g. a cache) is not part of the program.
+    g = fn.__globals__
+    for name in sorted(_global_names(fn.__code__)):
+        if name not in g:
+            continue
+        value = g[name]
+        h.update(("global:%s;" % (name)).encode())
+        if value is None or isinstance(value, (bool, int, float, complex, str, bytes, np.generic, np.ndarray,
+                                               dict, list, tuple, types.FunctionType, type, types.ModuleType)):
+            _canon(value, h, seen, memo)
+        else:
+            _canon(type(value), h, seen, memo)
+
+def _members(cls):
+    # Code defined in a class body: methods, properties, class and static methods.
+    members = {}
+    for key, value in vars(cls).items():
+        if isinstance(value, types.FunctionType):
+            members[key] = value
+        elif isinstance(value, property):
+            members[key] = (value.fget, value.fset, value.fdel)
+        elif isinstance(value, (classmethod, staticmethod)):
+            members[key] = value.__func__
+    return members
+
+def _canon(obj, h, seen, memo=None):
+    # Feed a canonical encoding of obj to the hash h.
+    if obj is None or isinstance(obj, (bool, int, str, bytes)):
+        h.update(("%s:%r;" % (type(obj).__name__, obj)).encode())
+    elif isinstance(obj, float):
+        h.update(("float:%s;" % (obj.hex())).encode())
+    elif isinstance(obj, complex):
+        h.update(("complex:%s,%s;" % (obj.real.hex(), obj.imag.hex())).encode())
+    elif isinstance(obj, np.generic):
+        _canon(obj.item(), h, seen, memo)
+    elif isinstance(obj, np.ndarray):
+        h.update(("ndarray:%s:%s;" % (obj.dtype.str, obj.shape)).encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif id(obj) in seen:
+        # Reference cycle.
+        h.update(b"cycle;")
+    elif isinstance(obj, dict):
+        seen.add(id(obj))
+        items = []
+        for key, value in obj.items():
+            hk = hashlib.sha256()
+            _canon(key, hk, seen, memo)
+            items.append((hk.hexdigest(), value))
+        h.update(("dict:%d{" % (len(items))).encode())
+        for hk, value in sorted(items, key=lambda item: item[0]):
+            h.update(hk.encode())
+            _canon(value, h, seen, memo)
+        h.update(b"}")
+        seen.discard(id(obj))
+    elif isinstance(obj, (list, tuple)):
+        seen.add(id(obj))
+        h.update(("%s:%d[" % (type(obj).__name__, len(obj))).encode())
+        for item in obj:
+            _canon(item, h, seen, memo)
+        h.update(b"]")
+        seen.discard(id(obj))
+    elif isinstance(obj, (set, frozenset)):
+        _canon(sorted(canonical_hash(item) for item in obj), h, seen, memo)
+    elif isinstance(obj, types.ModuleType):
+        h.update(("module:%s@%s;" % (obj.__name__, _version(obj.__name__))).encode())
+    elif isinstance(obj, types.CodeType):
+        h.update(("code:%s;" % (obj.co_name)).encode())
+        h.update(obj.co_code)
+        _canon(obj.co_names, h, seen, memo)
+        _canon(obj.co_consts, h, seen, memo)
+    elif isinstance(obj, types.FunctionType):
+        # Functions of installed packages: name and package version. Decorated functions (functools.wraps):
+        # the function they wrap. Others: code, defaults, closure variables and the module globals they use.
+        version = _library(obj)
+        if hasattr(obj, '__wrapped__'):
+            _canon(obj.__wrapped__, h, seen, memo)
+        elif version is not None:
+            h.update(("function:%s.%s@%s;" % (obj.__module__, obj.__qualname__, version)).encode())
+        else:
+            seen.add(id(obj))
+            h.update(("function:%s.%s;" % (obj.__module__, obj.__qualname__)).encode())
+            _canon(obj.__code__, h, seen, memo)
+            _canon(obj.__defaults__, h, seen, memo)
+            _canon([cell.cell_contents for cell in (obj.__closure__ or []) if cell.cell_contents is not obj], h, seen, memo)
+            _canon_globals(obj, h, seen, memo)
+            seen.discard(id(obj))
+    elif isinstance(obj, type):
+        # Classes: for every class of the MRO, its name and the code of its methods (or the package
+        # version, for classes of installed packages).
+        seen.add(id(obj))
+        for cls in obj.__mro__:
+            if cls is object:
+                continue
+            version = _library(cls)
+            if version is not None:
+                h.update(("class:%s.%s@%s;" % (cls.__module__, cls.__qualname__, version)).encode())
+            else:
+                h.update(("class:%s.%s;" % (cls.__module__, cls.__qualname__)).encode())
+                _canon(_members(cls), h, seen | {id(cls)}, memo)
+        seen.discard(id(obj))
+    elif hasattr(obj, 'get_cfg'):
+        # QickConfig (or a soc): its configuration, hashed once per object if memo is given.
+        if memo is None:
+            memo = {}
+        if id(obj) not in memo:
+            hc = hashlib.sha256()
+            _canon(obj.get_cfg(), hc, seen | {id(obj)})
+            memo[id(obj)] = (obj, hc.hexdigest())
+        h.update(("soccfg:%s;" % (memo[id(obj)][1])).encode())
+    elif hasattr(obj, '__dict__'):
+        seen.add(id(obj))
+        h.update(("object:%s.%s;" % (type(obj).__module__, type(obj).__qualname__)).encode())
+        _canon(vars(obj), h, seen, memo)
+        seen.discard(id(obj))
+    else:
+        h.update(("repr:%r;" % (obj)).encode())
+
+def canonical_hash(*objs):
+    """Hash of the contents of objects, independent of dict ordering and object identity.
+
+    Supports the types found in program configs: scalars, strings, numpy scalars and arrays,
+    dicts, lists, tuples, sets, objects (by their attributes, e.g. QickSweep), QickConfig
+    (by its configuration), functions and classes (by their code and closure variables).
+    """
+    return _canonical_hash(objs)
+
+def _canonical_hash(objs, memo=None):
+    h = hashlib.sha256()
+    for obj in objs:
+        _canon(obj, h, set(), memo)
+    return h.hexdigest()
+
+class _ProgramPickler(pickle.Pickler):
+    # Only the attributes of the program are stored: the soccfg and the program object itself
+    # (its class may be local to a function) are given back when loading.
+    def __init__(self, f, prog, soccfg):
+        super().__init__(f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.refs = {id(prog) : 'prog', id(soccfg) : 'soccfg'}
+
+    def persistent_id(self, obj):
+        return self.refs.get(id(obj))
+
+class _ProgramUnpickler(pickle.Unpickler):
+    def __init__(self, f, prog, soccfg):
+        super().__init__(f)
+        self.refs = {'prog' : prog, 'soccfg' : soccfg}
+
+    def persistent_load(self, pid):
+        if pid in self.refs:
+            return self.refs[pid]
+        raise pickle.UnpicklingError("unknown persistent id %s" % (pid))
+
+class ProgramCache():
+    """
+    ProgramCache class
+    Cache of compiled programs (e.g. AveragerProgramV2), so that rebuilding an unchanged program is a lookup.
+
+    Programs are keyed by a canonical hash of the program class (the code, closure variables and module
+    globals of the methods of all its classes but the qick ones), the qick version, the soccfg configuration
+    and the constructor arguments (cfg, reps, ...).
+    Objects used by the methods that are neither code nor plain values (e.g. a DelayTables) are hashed by
+    their class only.
+    The most recently used programs are kept in memory; with a path, programs are also pickled to disk
+    (the soccfg is not stored, and is attached back when loading), so they survive a kernel restart.
+
+    A cached program object is shared by all the callers that build it.
+    Programs whose compilation draws random numbers (e.g. T1 delay tables) come back with the same draw:
+    add a seed or counter to extra to get a new one.
+    """
+    def __init__(self, maxsize=64, path=None):
+        """
+        Parameters
+        ----------
+        maxsize : int
+            maximum number of programs kept in memory
+        path : str
+            directory of the disk cache (default: memory only)
+        """
+        self.logger  = logging.getLogger(self.__class__.__name__)
+        self.maxsize = maxsize
+        self.path    = path
+        self.entries = OrderedDict()
+        self.lock    = threading.RLock()
+        self.hits    = 0
+        self.disk_hits = 0
+        self.misses  = 0
+
+        # soccfg hashes, by object (the configuration does not change once the firmware is loaded).
+        self.memo    = {}
+
+    def key(self, cls, soccfg, args=(), kwargs={}, extra=None):
+        return _canonical_hash((_version('qick'), cls, soccfg, args, kwargs, extra), self.memo)
+
+    def build(self, cls, soccfg, *args, extra=None, **kwargs):
+        """Program cls(soccfg, *args, **kwargs), from the cache if it was built before.
+
+        Parameters
+        ----------
+        cls : class
+            program class
+        soccfg : QickConfig
+            firmware configuration
+        extra : object
+            anything else the program depends on (e.g. a random seed)
+
+        Returns
+        -------
+        object
+            the program
+        """
+        key = self.key(cls, soccfg, args, kwargs, extra)
+        with self.lock:
+            prog = self.entries.get(key)
+            if prog is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return prog
+
+            prog = self._load(key, cls, soccfg)
+            if prog is not None:
+                self.disk_hits += 1
+            else:
+                self.misses += 1
+                prog = cls(soccfg, *args, **kwargs)
+                self._save(key, prog, soccfg)
+
+            self.entries[key] = prog
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+            return prog
+
+    def _fname(self, key):
+        return os.path.join(self.path, 'prog_%s.pkl' % (key[:32]))
+
+    def _load(self, key, cls, soccfg):
+        if self.path is None or not os.path.exists(self._fname(key)):
+            return None
+        try:
+            prog = cls.__new__(cls)
+            with open(self._fname(key), 'rb') as f:
+                prog.__dict__.update(_ProgramUnpickler(f, prog, soccfg).load())
+            return prog
+        except Exception as e:
+            self.logger.warning("could not load cached program %s: %s" % (key[:32], e))
+            return None
+
+    def _save(self, key, prog, soccfg):
+        if self.path is None:
+            return
+        try:
+            buf = io.BytesIO()
+            _ProgramPickler(buf, prog, soccfg).dump(vars(prog))
+        except Exception as e:
+            self.logger.warning("could not pickle program %s: %s" % (type(prog).__name__, e))
+            return
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self._fname(key) + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(buf.getvalue())
+        os.replace(tmp, self._fname(key))
+
+    def clear(self, disk=False):
+        """Empty the memory cache (and the disk cache, with disk).
+        """
+        with self.lock:
+            self.entries.clear()
+            if disk and self.path is not None and os.path.isdir(self.path):
+                for fname in os.listdir(self.path):
+                    if fname.startswith('prog_') and fname.endswith('.pkl'):
+                        os.remove(os.path.join(self.path, fname))
+
+    def stats(self):
+        return {'size'      : len(self.entries),
+                'hits'      : self.hits,
+                'disk_hits' : self.disk_hits,
+                'misses'    : self.misses}
@@ -0,0 +1,280 @@
+''' Batched calls to a remote QickTrainingSoc (qick.pyro): one network round trip for many driver calls,
+and a compact transport of the arrays they return '''
+import zlib
+import logging
+import numpy as np
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+class PackedArray():
+    """
+    PackedArray class
+    A numpy array as contiguous typed bytes, optionally converted to a smaller type and compressed.
+
+    The smaller type (e.g. int16, or float32: complex arrays become complex of that precision) is only
+    used when the conversion is exact, otherwise the array keeps its type (floating types: unless lossy).
+
+    Uncompressed data are kept as a uint8 view of the array, which numpy unpickles in the received bytes,
+    so the unpacked array is a writable view of them (a bytearray would be copied, on both sides, by pickle
+    protocol 4 as used by qick.pyro). Without a transport (a local soc), it can share memory with arr.
+    """
+    def __init__(self, arr, dtype=None, compress=None, level=1, lossy=False, checksum=False):
+        """
+        Parameters
+        ----------
+        arr : numpy.ndarray
+            the array
+        dtype : numpy dtype
+            type to send the data as (default: the type of arr)
+        compress : str
+            None, 'zlib' or 'lz4' (if installed)
+        level : int
+            compression level
+        lossy : bool
+            convert to a floating dtype even when the conversion loses precision
+        checksum : bool
+            send a CRC32 of the typed bytes, checked by unpack (the transport, TCP, already checks its bytes)
+        """
+        arr = np.asarray(arr)
+        if dtype is not None:
+            dtype = np.dtype(dtype)
+            if arr.dtype.kind not in 'biufc' or (dtype.kind in 'biu' and arr.dtype.kind == 'c'):
+                raise TypeError("cannot send %s data as %s" % (arr.dtype, dtype))
+            if arr.dtype.kind == 'c':
+                dtype = np.result_type(dtype, np.complex64)
+            cast = arr.astype(dtype)
+            if (lossy and dtype.kind in 'fc') or np.array_equal(cast, arr, equal_nan=dtype.kind in 'fc'):
+                arr = cast
+        arr = np.ascontiguousarray(arr)
+
+        self.dtype    = arr.dtype.str
+        self.shape    = arr.shape
+        self.compress = compress
+        self.crc      = zlib.crc32(memoryview(arr).cast('B')) if checksum else None
+        if compress is None:
+            self.data = arr.reshape(-1).view(np.uint8)
+        elif compress == 'zlib':
+            self.data = zlib.compress(memoryview(arr).cast('B'), level)
+        elif compress == 'lz4':
+            if lz4 is None:
+                raise RuntimeError("lz4 compression needs the lz4 package")
+            self.data = lz4.compress(memoryview(arr).cast('B'), compression_level=level)
+        else:
+            raise ValueError("unknown compression %s" % (compress))
+
+    def unpack(self):
+        """The array, writable: a view of the received bytes if they were not compressed
+        (decompressed bytes are copied once, into a bytearray).
+        """
+        data = self.data
+        if self.compress == 'zlib':
+            data = bytearray(zlib.decompress(data))
+        elif self.compress == 'lz4':
+            data = lz4.decompress(data, return_bytearray=True)
+        if self.crc is not None and zlib.crc32(data) != self.crc:
+            raise ValueError("packed array %s %s: checksum mismatch" % (self.dtype, self.shape))
+        return np.frombuffer(data, dtype=self.dtype).reshape(self.shape)
+
+def pack_arrays(obj, dtype=None, compress=None, level=1, min_size=4096, lossy=False, checksum=False):
+    """Replace the numpy arrays of obj (and of the lists, tuples and dicts in it) of at least
+    min_size bytes with PackedArray.
+    """
+    if isinstance(obj, np.ndarray):
+        if obj.nbytes >= min_size and obj.dtype.kind in 'biufc':
+            return PackedArray(obj, dtype, compress, level, lossy, checksum)
+        return obj
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(pack_arrays(item, dtype, compress, level, min_size, lossy, checksum) for item in obj)
+    elif isinstance(obj, dict):
+        return {key : pack_arrays(value, dtype, compress, level, min_size, lossy, checksum) for key, value in obj.items()}
+    return obj
+
+def unpack_arrays(obj):
+    """Inverse of pack_arrays.
+    """
+    if isinstance(obj, PackedArray):
+        return obj.unpack()
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(unpack_arrays(item) for item in obj)
+    elif isinstance(obj, dict):
+        return {key : unpack_arrays(value) for key, value in obj.items()}
+    return obj
+
+class BatchResult():
+    """
+    BatchResult class
+    Result of a queued operation, available (value) once the batch is executed.
+    """
+    def __init__(self, index):
+        self.index = index
+        self.done  = False
+        self.value = None
+
+    def __repr__(self):
+        if self.done:
+            return "BatchResult(%r)" % (self.value,)
+        return "BatchResult(pending)"
+
+class _BatchTarget():
+    # An object on the server side, reached from the soc by path: attribute access and indexing
+    # (any key, e.g. a list index or a config key, added to the path as [key]) extend the path,
+    # calls and attribute assignments are queued in the batch.
+    def __init__(self, batch, path):
+        object.__setattr__(self, '_batch', batch)
+        object.__setattr__(self, '_path', path)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return _BatchTarget(self._batch, self._path + (name,))
+
+    def __getitem__(self, index):
+        return _BatchTarget(self._batch, self._path + ([index],))
+
+    def __setattr__(self, name, value):
+        self._batch._queue('set', self._path, name, value)
+
+    def __call__(self, *args, **kwargs):
+        if len(self._path) == 0 or not isinstance(self._path[-1], str):
+            raise TypeError("only methods can be called in a batch")
+        return self._batch._queue('call', self._path[:-1], self._path[-1], (args, kwargs))
+
+class BatchProxy():
+    """
+    BatchProxy class
+    Queues driver calls to a (remote) QickTrainingSoc and runs them all with one soc.run_batch call.
+
+    The proxy looks like the soc: method calls, and assignments of attributes (e.g. registers),
+    on the soc and the objects reached from it are queued and return a BatchResult, filled in by execute.
+    Attribute reads are queued with get. Used as a context manager, the batch is executed on exit::
+
+        soc, soccfg = make_proxy(ns_host='...')
+        with BatchProxy(soc) as batch:
+            for simu_ch in range(4):
+                batch.config_resonator(simu_ch=simu_ch, f=500.0+10*simu_ch)
+            table = batch.get(batch.simu[0].kidsim, 'table')
+        print(table.value, batch.round_trips)
+
+    Arguments and results are sent whole (pickled by Pyro), so objects that are not picklable
+    (e.g. the drivers themselves) cannot be passed or returned.
+    With pack, the arrays in the results are sent as PackedArray (see pack_arrays), and unpacked here.
+    """
+    def __init__(self, soc, max_calls=None, pack=None):
+        """
+        Parameters
+        ----------
+        soc : Pyro4.Proxy or QickTrainingSoc
+            the soc (a local soc also works, e.g. for testing)
+        max_calls : int
+            execute the batch automatically when this many operations are queued (default: no limit)
+        pack : dict
+            arguments of pack_arrays (dtype, compress, ...) for the results (default: results sent as they are)
+        """
+        self.logger      = logging.getLogger(self.__class__.__name__)
+        self.soc         = soc
+        self.max_calls   = max_calls
+        self.pack        = pack
+        self.calls       = []
+        self.results     = []
+        self.round_trips = 0
+        self.ncalls      = 0
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(_BatchTarget(self, ()), name)
+
+    def __getitem__(self, index):
+        return _BatchTarget(self, ())[index]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+        return False
+
+    def _queue(self, op, path, name, value):
+        result = BatchResult(len(self.calls))
+        self.calls.append((op, path, name, value))
+        self.results.append(result)
+        if self.max_calls is not None and len(self.calls) >= self.max_calls:
+            self.execute()
+        return result
+
+    def get(self, target, name=None):
+        """Queue a read of attribute name of target (the batch itself, or an object reached from it),
+        or of target itself if name is None (e.g. batch.get(batch['tprocs'])).
+        """
+        if isinstance(target, BatchProxy):
+            target = _BatchTarget(self, ())
+        return self._queue('get', target._path, name, None)
+
+    def execute(self):
+        """Run the queued operations, in one round trip.
+
+        Returns
+        -------
+        list
+            result of each operation
+        """
+        calls, results = self.calls, self.results
+        self.calls, self.results = [], []
+        if not calls:
+            return []
+
+        self.round_trips += 1
+        self.ncalls += len(calls)
+        if self.pack is None:
+            values = self.soc.run_batch(calls)
+        else:
+            values = unpack_arrays(self.soc.run_batch(calls, self.pack))
+        for result, value in zip(results, values):
+            result.value = value
+            result.done  = True
+        self.logger.debug("execute %d calls"%(len(calls)))
+        return values
+
+class PackedProxy():
+    """
+    PackedProxy class
+    Wraps a (remote) QickTrainingSoc: method calls go through soc.run_batch, so the arrays they return
+    (e.g. get_decimated, or the raw buffers read by acquire) are sent as PackedArray.
+    Anything else (attributes, items) is passed to the soc.
+
+    A program can acquire through it: prog.acquire(PackedProxy(soc, dtype=np.int16)).
+    """
+    def __init__(self, soc, dtype=None, compress=None, level=1, min_size=4096, lossy=False, checksum=False):
+        """
+        Parameters
+        ----------
+        soc : Pyro4.Proxy or QickTrainingSoc
+            the soc
+        dtype, compress, level, min_size, lossy, checksum :
+            see pack_arrays
+        """
+        self.soc  = soc
+        self.pack = {'dtype'    : dtype,
+                     'compress' : compress,
+                     'level'    : level,
+                     'min_size' : min_size,
+                     'lossy'    : lossy,
+                     'checksum' : checksum}
+
+    def __getattr__(self, name):
+        attr = getattr(self.soc, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            return unpack_arrays(self.soc.run_batch([('call', (), name, (args, kwargs))], self.pack)[0])
+        return call
+
+    def __getitem__(self, key):
+        return self.soc[key]
+
+    def __setitem__(self, key, value):
+        self.soc[key] = value
@@ -1,10 +1,47 @@
-from qick.qick import *
+try:
+    from qick.qick import *
+except ImportError:
+    # No pynq (not on a board): only the mock backend can be used
+    # (QickSoc, and so QickTrainingSoc, raise when constructed).
+    from qick import QickConfig
+    from drivers.mock import QickSoc
+
+try:
+    from qick.asm_v2 import AveragerProgramV2, DerefDmem, QickSweep
+    HAVE_TPROC_V2 = True
+except ImportError as e:
+    # Older qick without tProc v2 support: the readout programs are not available,
+    # and the placeholders below raise when used.
+    HAVE_TPROC_V2 = False
+    TPROC_V2_ERROR = "the readout programs need qick with tProc v2 support (qick.asm_v2): %s" % (e)
+
+    class AveragerProgramV2():
+        def __init__(self, *args, **kwargs):
+            raise ImportError(TPROC_V2_ERROR)
+
+    DerefDmem = QickSweep = AveragerProgramV2
 
 from drivers.pfb import *
 from drivers.misc import *
+from pyro_batch import pack_arrays
+from tracing import Tracer
+from async_runner import AsyncRunner
 
+import os
+import copy
+import math
+import json
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 import logging
 
 class AnalysisChain():
@@ -45,10 +82,10 @@ class AnalysisChain():
         }}
     
     # Constructor.
-    def __init__(self, soc, chain):
+    def __init__(self, soc, chain, lazy=False):
         self.logger = logging.getLogger(self.__class__.__name__)
         # Sanity check. Is soc the right type?
-        if isinstance(soc, QickTrainingSoc) == False:
+        if isinstance(soc, QickTrainingConfig) == False:
             raise RuntimeError("%s (QickTraining, AnalysisChain)" % __class__.__name__)
         else:
             # Soc instance.
@@ -64,23 +101,30 @@ class AnalysisChain():
                 # Analysis chain.
                 self.dict['chain'] = chain
 
-                # Update settings.
-                self.update_settings()
+                # Update settings (in lazy mode, on first access to the mixer settings).
+                if not lazy:
+                    self.update_settings()
                     
-                # pfb block.
-                pfb = getattr(self.soc, self.dict['chain']['pfb'])
-
                 # Does the chain has a kidsim?
-                if pfb.HAS_KIDSIM:
+                if 'fr' in self.dict['chain']:
                     # Frequency resolution (MHz).
-                    kidsim = getattr(self.soc, self.dict['chain']['kidsim'])
-                    self.dict['fr'] = kidsim.DF_DDS/1e6
+                    self.dict['fr'] = self.dict['chain']['fr']
+
+                # Channel centers.
+                self.dict['centers'] = pfb_channel_centers(chain['fs'], chain['nch'])
  
     def update_settings(self):
         self.logger.debug("update_settings")
+        # Config snapshot: mixer settings recorded when it was exported.
+        if 'mixer' in self.dict['chain']:
+            self.dict['mixer'] = dict(self.dict['chain']['mixer'])
+            self.dict['nqz'] = self.dict['chain']['nqz']
+            return
+
         id_ = self.dict['chain']['adc']['id']
         tile, ch = self.soc['adcs'][id_]['index']
-        m_set = self.soc.rf.adc_tiles[tile].blocks[ch].MixerSettings
+        block = self.soc.rf.adc_tiles[tile].blocks[ch]
+        m_set = block.MixerSettings
         self.dict['mixer'] = {
             'mode'     : self.return_key(self.mixer_dict['mode'], m_set['MixerMode']),
             'type'     : self.return_key(self.mixer_dict['type'], m_set['MixerType']),
@@ -88,10 +132,17 @@ class AnalysisChain():
             'freq'     : -self.soc['adcs'][id_]['fs']/4
         }
         
-        self.dict['nqz'] = self.soc.rf.adc_tiles[tile].blocks[ch].NyquistZone        
+        self.dict['nqz'] = block.NyquistZone
+
+    @property
+    def mixer(self):
+        # Mixer settings, read from the RF block on first access.
+        if 'mixer' not in self.dict:
+            self.update_settings()
+        return self.dict['mixer']
 
     def get_mixer_frequency(self):
-        return self.dict['mixer']['freq']
+        return self.mixer['freq']
         
     def return_key(self,dictionary,val):
         for key, value in dictionary.items():
@@ -99,33 +150,40 @@ class AnalysisChain():
                 return key
         return('Key Not Found')
     
-    def freq2ch(self, f):
-        # Get blocks.
-        pfb_b = getattr(self.soc, self.dict['chain']['pfb'])
-        
+    def freq2ch(self, f, out_of_range='raise'):
+        """PFB channel of frequencies (MHz, scalar or array), including the mixer offset.
+        out_of_range is 'raise' (ValueError) or 'mask' (masked array).
+        """
         # Sanity check: is frequency on allowed range?
-        fmix = abs(self.dict['mixer']['freq'])
+        fmix = abs(self.mixer['freq'])
         fs = self.dict['chain']['fs']
-              
-        if (fmix-fs/2) < f < (fmix+fs/2):
-            f_ = f - fmix
-            return pfb_b.freq2ch(f_)
-        else:
-            raise ValueError("Frequency value %f out of allowed range [%f,%f]" % (f,fmix-fs/2,fmix+fs/2))
+        if np.isscalar(f):
+            if not ((fmix-fs/2) < f < (fmix+fs/2)) and out_of_range == 'raise':
+                raise ValueError("Frequency value %f out of allowed range [%f,%f]" % (f,fmix-fs/2,fmix+fs/2))
+            return pfb_freq2ch(f - fmix, fs, self.dict['chain']['nch'], out_of_range)
 
-    def ch2freq(self, ch):
-        # Get blocks.
-        pfb_b = getattr(self.soc, self.dict['chain']['pfb'])
+        f = np.asarray(f, dtype=float)
+        valid = ((fmix-fs/2) < f) & (f < (fmix+fs/2))
+        if out_of_range == 'raise' and not np.all(valid):
+            raise ValueError("Frequency value %s out of allowed range [%f,%f]" % (f[~valid],fmix-fs/2,fmix+fs/2))
+
+        return pfb_freq2ch(f - fmix, fs, self.dict['chain']['nch'], out_of_range)
 
+    def ch2freq(self, ch, out_of_range='raise'):
+        """Center frequency (MHz) of channels (scalar or array), including the mixer offset.
+        """
         # Mixer frequency.
-        fmix = abs(self.dict['mixer']['freq'])
-        f = pfb_b.ch2freq(ch) 
+        fmix = abs(self.mixer['freq'])
+        f = pfb_ch2freq(ch, self.dict['centers'], out_of_range)
         
         return f+fmix
     
-    def qout(self,q):
+    def qout(self, q, force=False):
         self.logger.debug("qout %s"%(q))
+        # Unchanged values are skipped by the register shadow of the PFB, when enabled (see ShadowSocIp).
         pfb = getattr(self.soc, self.dict['chain']['pfb'])
+        if force:
+            pfb.shadow_invalidate()
         pfb.qout(q)
         
     @property
@@ -188,10 +246,10 @@ class SynthesisChain():
         }}    
 
     # Constructor.
-    def __init__(self, soc, chain):
+    def __init__(self, soc, chain, lazy=False):
         self.logger = logging.getLogger(self.__class__.__name__)
         # Sanity check. Is soc the right type?
-        if isinstance(soc, QickTrainingSoc) == False:
+        if isinstance(soc, QickTrainingConfig) == False:
             raise RuntimeError("%s (QickTraining, AnalysisChain)" % __class__.__name__)
         else:
             # Soc instance.
@@ -207,23 +265,30 @@ class SynthesisChain():
                 # Synthesis chain.
                 self.dict['chain'] = chain
 
-                # pfb block.
-                pfb = getattr(self.soc, self.dict['chain']['pfb'])
-
                 # Does this chain has a kidsim?
-                if pfb.HAS_KIDSIM:
+                if 'fr' in self.dict['chain']:
                     # Set frequency resolution (MHz).
-                    kidsim = getattr(self.soc, self.dict['chain']['kidsim'])
-                    self.dict['fr'] = kidsim.DF_DDS/1e6
+                    self.dict['fr'] = self.dict['chain']['fr']
+
+                # Channel centers.
+                self.dict['centers'] = pfb_channel_centers(chain['fs'], chain['nch'])
 
-                # Update settings.
-                self.update_settings()
+                # Update settings (in lazy mode, on first access to the mixer settings).
+                if not lazy:
+                    self.update_settings()
 
     def update_settings(self):
         self.logger.debug("update_settings")
+        # Config snapshot: mixer settings recorded when it was exported.
+        if 'mixer' in self.dict['chain']:
+            self.dict['mixer'] = dict(self.dict['chain']['mixer'])
+            self.dict['nqz'] = self.dict['chain']['nqz']
+            return
+
         id_ = self.dict['chain']['dac']['id']
         tile, ch = self.soc['dacs'][id_]['index']
-        m_set = self.soc.rf.dac_tiles[tile].blocks[ch].MixerSettings
+        block = self.soc.rf.dac_tiles[tile].blocks[ch]
+        m_set = block.MixerSettings
         self.dict['mixer'] = {
             'mode'     : self.return_key(self.mixer_dict['mode'], m_set['MixerMode']),
             'type'     : self.return_key(self.mixer_dict['type'], m_set['MixerType']),
@@ -231,43 +296,59 @@ class SynthesisChain():
             'freq'     : self.soc['dacs'][id_]['fs']/4
         }
         
-        self.dict['nqz'] = self.soc.rf.dac_tiles[tile].blocks[ch].NyquistZone        
-        
+        self.dict['nqz'] = block.NyquistZone
+
+    @property
+    def mixer(self):
+        # Mixer settings, read from the RF block on first access.
+        if 'mixer' not in self.dict:
+            self.update_settings()
+        return self.dict['mixer']
+
+    def get_mixer_frequency(self):
+        return self.mixer['freq']
+
     def return_key(self,dictionary,val):
         for key, value in dictionary.items():
             if value==val:
                 return key
         return('Key Not Found')
     
-    def freq2ch(self, f):
-        # Get blocks.
-        pfb_b = getattr(self.soc, self.dict['chain']['pfb'])
-        
+    def freq2ch(self, f, out_of_range='raise'):
+        """PFB channel of frequencies (MHz, scalar or array), including the mixer offset.
+        out_of_range is 'raise' (ValueError) or 'mask' (masked array).
+        """
         # Sanity check: is frequency on allowed range?
-        fmix = abs(self.dict['mixer']['freq'])
+        fmix = abs(self.mixer['freq'])
         fs = self.dict['chain']['fs']
-                
-        if (fmix-fs/2) < f < (fmix+fs/2):
-            f_ = f - fmix
-            return pfb_b.freq2ch(f_)
+        if np.isscalar(f):
+            if not ((fmix-fs/2) < f < (fmix+fs/2)) and out_of_range == 'raise':
+                raise ValueError("Frequency value %f out of allowed range [%f,%f]" % (f,fmix-fs/2,fmix+fs/2))
+            return pfb_freq2ch(f - fmix, fs, self.dict['chain']['nch'], out_of_range)
 
-        else:
-            raise ValueError("Frequency value %f out of allowed range [%f,%f]" %(f, fmix-fs/2, fmix+fs/2))          
+        f = np.asarray(f, dtype=float)
+        valid = ((fmix-fs/2) < f) & (f < (fmix+fs/2))
+        if out_of_range == 'raise' and not np.all(valid):
+            raise ValueError("Frequency value %s out of allowed range [%f,%f]" % (f[~valid],fmix-fs/2,fmix+fs/2))
 
-    def ch2freq(self, ch):
-        # Get blocks.
-        pfb_b = getattr(self.soc, self.dict['chain']['pfb'])
+        return pfb_freq2ch(f - fmix, fs, self.dict['chain']['nch'], out_of_range)
 
-        # Sanity check: is frequency on allowed range?
-        fmix = abs(self.dict['mixer']['freq'])
-        f = pfb_b.ch2freq(ch)
+    def ch2freq(self, ch, out_of_range='raise'):
+        """Center frequency (MHz) of channels (scalar or array), including the mixer offset.
+        """
+        # Mixer frequency.
+        fmix = abs(self.mixer['freq'])
+        f = pfb_ch2freq(ch, self.dict['centers'], out_of_range)
         
         return f+fmix
             
     # PFB quantization.
-    def qout(self,q):
+    def qout(self, q, force=False):
         self.logger.debug("qout %s"%(q))
+        # Unchanged values are skipped by the register shadow of the PFB, when enabled (see ShadowSocIp).
         pfb = getattr(self.soc, self.dict['chain']['pfb'])
+        if force:
+            pfb.shadow_invalidate()
         pfb.qout(q)
         
     @property
@@ -292,10 +373,10 @@ class SynthesisChain():
     
 class SimuChain():
     # Constructor.
-    def __init__(self, soc, simu=None, name=""):
+    def __init__(self, soc, simu=None, name="", lazy=False):
         self.logger = logging.getLogger(self.__class__.__name__)
         # Sanity check. Is soc the right type?
-        if isinstance(soc, QickTrainingSoc) == False:
+        if isinstance(soc, QickTrainingConfig) == False:
             raise RuntimeError("%s (QickTraining, AnalysisChain)" % __class__.__name__)
         else:
             # Soc instance.
@@ -304,15 +385,30 @@ class SimuChain():
             # Chain name.
             self.name = name
 
+            # Held while the chain is being configured (see QickTrainingSoc.config_resonators).
+            self.lock = threading.RLock()
+
+            # Resonator presets (see load_presets).
+            self.presets = np.zeros(0, dtype=REGS_DTYPE)
+
             # analysis/sinthesis chains to access functions.
-            self.analysis   = AnalysisChain(self.soc, simu['analysis'])
-            self.synthesis  = SynthesisChain(self.soc, simu['synthesis'])
+            self.analysis   = AnalysisChain(self.soc, simu['analysis'], lazy=lazy)
+            self.synthesis  = SynthesisChain(self.soc, simu['synthesis'], lazy=lazy)
 
             # Frequency resolution.
             fr_min = min(self.analysis.fr,self.synthesis.fr)
             fr_max = max(self.synthesis.fr,self.synthesis.fr)
             self.fr = fr_max
 
+    @property
+    def kidsim(self):
+        return getattr(self.soc, self.analysis.dict['chain']['kidsim'])
+
+    @property
+    def L(self):
+        # Number of kidsim lanes (one resonator per lane).
+        return self.analysis.dict['chain']['L']
+
     def enable(self, f, t=None, N=None, verbose=False):
         self.logger.debug("enable %s %s %s"%(f, t, N))
         # Config dictionary.
@@ -329,16 +425,41 @@ class SimuChain():
         cfg_ = {'sel' : 'input', 'freq' : f}
         self.set_resonator(cfg_, verbose=verbose)
 
-    def alloff(self, verbose=False):
+    def active(self):
+        """Resonator table entries (TABLE_DTYPE) of the lanes that are on (output not set to the input).
+        """
+        table = self.kidsim.table
+        return table[table['valid'] & (table['outsel'] != OUTSEL['input'])].copy()
+
+    def alloff(self, verbose=False, keep=None, force=False):
+        """Set all lanes to pass the input through.
+
+        Unless force, only the lanes that are on or whose contents are unknown (see AxisKidsimV3.table)
+        are written, and the lanes listed in keep are left alone.
+        """
         self.logger.debug("alloff")
         # Config dictionary.
         cfg_ = {'sel' : 'input'}
 
         # Kidsim block.
         kidsim_b = getattr(self.soc, self.analysis.dict['chain']['kidsim'])
-        kidsim_b.setall(cfg_, verbose=verbose) 
+        if force:
+            kidsim_b.setall(cfg_, verbose=verbose) 
+        else:
+            table = kidsim_b.table
+            off = ~table['valid'] | (table['outsel'] != OUTSEL['input'])
+            if keep is not None:
+                off[np.asarray(keep, dtype=np.int64)] = False
+            lanes = np.flatnonzero(off)
+            if len(lanes) > 0:
+                # Same register image as setall (channel 0 of each lane).
+                regs, sweep_time, clamp = kidsim_b.compile_regs(lanes, sel='input')
+                kidsim_b.write_resonators(regs, verbose=verbose)
 
-    def set_resonator(self, cfg, verbose=False):
+    def set_resonator(self, cfg, verbose=False, force=False):
+        """Place a resonator on the channel of cfg['freq'].
+        Unless force, nothing is written if the lane already holds the same registers.
+        """
         self.logger.debug("set_resonator %s"%(cfg))
         # Get blocks.
         pfb_b       = getattr(self.soc, self.analysis.dict['chain']['pfb'])
@@ -364,39 +485,472 @@ class SimuChain():
             cfg['dds_freq'] = fdds
 
             # Set resonator.
-            kidsim_b.set_resonator(cfg, verbose=verbose)
+            if force:
+                kidsim_b.set_resonator(cfg, verbose=verbose)
+            else:
+                kidsim_b.set_resonator_config(cfg, verbose=verbose)
+                regs = kidsim_b.config_regs(cfg, verbose=verbose)
+                entry = kidsim_b.lookup(k)
+                if entry is None or entry.tolist()[:-1] != tuple(regs):
+                    kidsim_b.set_registers(*regs)
                 
         else:
             raise ValueError("Frequency value %f out of allowed range [%f,%f]" % (f,fmix-fs/2,fmix+fs/2))
 
-    def qout(self,q):
+    def compile_resonators(self, configs):
+        """Compile resonator configs into register images, without touching the hardware.
+
+        Parameters
+        ----------
+        configs : list of dict
+            resonator configs, with the same keys as for set_resonator (freq, and optionally
+            sel, sweep_freq, sweep_time, nstep or dds_wait, iir_c0, iir_c1)
+
+        Returns
+        -------
+        numpy.ndarray
+            REGS_DTYPE array with the register image of each config, for write_resonators
+        """
+        f = np.array([config['freq'] for config in configs], dtype=float)
+        k = np.atleast_1d(self.analysis.freq2ch(f))
+        fdds = f - np.atleast_1d(self.analysis.ch2freq(k))
+
+        configs_ = []
+        for config, k_, fdds_ in zip(configs, k, fdds):
+            config = dict(config)
+            config['channel'] = int(k_)
+            config['dds_freq'] = fdds_
+            configs_.append(config)
+
+        return self.kidsim.resonator_regs(configs_)
+
+    def write_resonators(self, regs, alloff=False, verbose=False):
+        """Write register images (see compile_resonators), skipping the lanes that already hold them.
+        With the register shadow enabled (QickTrainingSoc.shadow_regs), only the registers that differ
+        from the last lane written are written.
+
+        Parameters
+        ----------
+        regs : numpy.ndarray
+            REGS_DTYPE array, at most one row per lane
+        alloff : bool
+            disable the other lanes
+
+        Returns
+        -------
+        int
+            number of lanes written
+        """
+        regs = np.atleast_1d(regs)
+        if len(np.unique(regs['addr'])) < len(regs):
+            raise ValueError("Resonators on channels %s share a kidsim lane" % (regs['punct']*self.L + regs['addr']))
+
+        kidsim_b = self.kidsim
+        with self.lock:
+            if alloff:
+                self.alloff(keep=regs['addr'], verbose=verbose)
+            regs = regs[~kidsim_b.unchanged(regs)]
+            kidsim_b.write_resonators(regs, verbose=verbose)
+        return len(regs)
+
+    def load_presets(self, presets):
+        """Compile a bank of resonator presets (see compile_resonators), to be activated later by index.
+        The register images are kept in self.presets.
+        """
+        self.logger.debug("load_presets %d presets"%(len(presets)))
+        self.presets = self.compile_resonators(presets)
+        return self.presets
+
+    def activate(self, index, alloff=False, verbose=False):
+        """Activate presets from the bank (see load_presets and write_resonators).
+
+        Parameters
+        ----------
+        index : int or list of int
+            preset(s) to activate (on different lanes)
+        alloff : bool
+            disable the other lanes
+
+        Returns
+        -------
+        int
+            number of lanes written
+        """
+        self.logger.debug("activate %s"%(index))
+        return self.write_resonators(self.presets[np.atleast_1d(index)], alloff, verbose)
+
+    def qout(self, q, force=False):
         self.logger.debug("qout %s"%(q))
-        self.analysis.qout(q)
-        self.synthesis.qout(q)
+        self.analysis.qout(q, force)
+        self.synthesis.qout(q, force)
 
-class QickTrainingSoc(QickSoc, QickConfig):    
+class LazyList():
+    """
+    LazyList class
+    Read-only list whose items are built on first access, by calling build(index), and then cached.
+    """
+    def __init__(self, n, build):
+        self._items = [None]*n
+        self._build = build
 
-    # Constructor.
-    def __init__(self, bitfile, **kwargs):
-        self.logger = logging.getLogger(self.__class__.__name__)
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if self._items[i] is None:
+            self._items[i] = self._build(range(len(self))[i])
+        return self._items[i]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def built(self):
+        """Indices of the items built so far.
         """
-        Constructor method
+        return [i for i, item in enumerate(self._items) if item is not None]
+
+    def __repr__(self):
+        return "LazyList(%d items, %d built)" % (len(self), len(self.built()))
+
+# Resonator allocation (see ResonatorAllocator).
+ALLOC_DTYPE = np.dtype([('freq'    , float),
+                        ('chain'   , np.int64),
+                        ('channel' , np.int64),
+                        ('lane'    , np.int64),
+                        ('punct'   , np.int64),
+                        ('dds_freq', float),
+                        ('ok'      , bool)])
+
+class ResonatorAllocator():
+    """
+    ResonatorAllocator class
+    Assigns resonator frequencies to simulator chains and PFB channels without kidsim lane collisions.
+
+    Each kidsim lane holds one resonator, so two resonators on channels with the same lane
+    (channel mod L) of the same chain cannot coexist.
+    A frequency can go on the nearest channel of any chain covering it, or on the next nearest
+    channel if the DDS offset stays within max_offset.
+
+    The DDS offset is limited to half the channel spacing (fc_ch/2) by default: every resonator sits on
+    its nearest channel, within the passband of the PFB channel filter. max_offset can be raised up to
+    fc_ch, letting a resonator move to the neighbouring channel to avoid a collision; beyond fc_ch/2
+    the resonator is on the roll-off of the channel filter, and its response is attenuated.
+    Requests are matched to (chain, lane) slots with augmenting paths, so a request is only
+    reported impossible if no collision-free assignment exists.
+    """
+    def __init__(self, simu, max_offset=None):
+        """
+        Parameters
+        ----------
+        simu : list of SimuChain
+            simulator chains to allocate on
+        max_offset : float
+            largest allowed DDS offset from the channel center, in MHz, at most fc_ch
+            (default: fc_ch/2, half the channel spacing)
+        """
+        self.simu = simu
+        self.max_offset = max_offset
+
+    def candidates(self, freqs, chains=None):
+        """Possible placements of each frequency, best (smallest DDS offset) first.
+        Each placement is (|offset|, chain, channel, lane, offset).
+        """
+        freqs = np.atleast_1d(np.asarray(freqs, dtype=float))
+        if chains is None:
+            chains = np.full(len(freqs), -1)
+        chains = np.broadcast_to(chains, freqs.shape)
+
+        cands = [[] for f in freqs]
+        for c, simu in enumerate(self.simu):
+            an = simu.analysis
+            L = simu.L
+            max_offset = an.fc_ch/2 if self.max_offset is None else self.max_offset
+            if max_offset > an.fc_ch:
+                raise ValueError("max_offset=%f MHz is beyond the channel spacing %f MHz" % (max_offset, an.fc_ch))
+
+            # Nearest channel, and the neighbour on the side of the frequency.
+            k0 = an.freq2ch(freqs, out_of_range='mask')
+            valid = ~np.ma.getmaskarray(k0) & ((chains < 0) | (chains == c))
+            k0 = np.ma.filled(k0, 0)
+            side = np.where(freqs >= an.ch2freq(k0), 1, -1)
+            k1 = np.mod(k0 + side, an.dict['chain']['nch'])
+
+            for k in [k0, k1]:
+                fdds = freqs - an.ch2freq(k)
+                ok = valid & (np.abs(fdds) <= max_offset)
+                for i in np.flatnonzero(ok):
+                    cands[i].append((abs(fdds[i]), c, int(k[i]), int(k[i]) % L, fdds[i]))
+
+        for cand in cands:
+            cand.sort()
+        return cands
+
+    def allocate(self, freqs, chains=None):
+        """Collision-free assignment of resonator frequencies.
+
+        Parameters
+        ----------
+        freqs : array of float
+            resonator frequencies, in MHz
+        chains : array of int
+            simulator chain of each request, or -1 for any (default: any)
+
+        Returns
+        -------
+        numpy.ndarray
+            ALLOC_DTYPE array, one row per request; ok is False for requests that cannot be placed
         """
-        QickSoc.__init__(self, bitfile, **kwargs)
+        freqs = np.atleast_1d(np.asarray(freqs, dtype=float))
+        cands = self.candidates(freqs, chains)
 
-        self.map_local()
+        # Slot index: (chain, lane) -> request.
+        owner  = {}
+        choice = [None]*len(freqs)
 
+        def augment(i, seen):
+            for cand in cands[i]:
+                slot = (cand[1], cand[3])
+                if slot in seen:
+                    continue
+                seen.add(slot)
+                j = owner.get(slot)
+                if j is None or augment(j, seen):
+                    owner[slot] = i
+                    choice[i] = cand
+                    return True
+            return False
+
+        # Most constrained requests first.
+        for i in sorted(range(len(freqs)), key=lambda i: len(cands[i])):
+            augment(i, set())
+
+        alloc = np.zeros(len(freqs), dtype=ALLOC_DTYPE)
+        alloc['freq']  = freqs
+        alloc['chain'] = -1
+        for i, cand in enumerate(choice):
+            if cand is not None:
+                offset, c, k, lane, fdds = cand
+                alloc[i] = (freqs[i], c, k, lane, k//self.simu[c].L, fdds, True)
+
+        if not np.all(alloc['ok']):
+            logging.getLogger(self.__class__.__name__).warning(
+                "could not place %d of %d resonators" % (np.sum(~alloc['ok']), len(freqs)))
+        return alloc
+
+def _fclk(soccfg, gen_ch=None, ro_ch=None):
+    # Clock (MHz) of the times of a generator, a readout or the tProc.
+    if gen_ch is not None and ro_ch is not None:
+        raise RuntimeError("can't specify both gen_ch and ro_ch!")
+    if gen_ch is not None:
+        return soccfg['gens'][gen_ch]['f_fabric']
+    elif ro_ch is not None:
+        return soccfg['readouts'][ro_ch]['f_fabric']
+    else:
+        return soccfg['tprocs'][0]['f_time']
+
+def us2cycles_array(soccfg, us, gen_ch=None, ro_ch=None, as_float=False, dtype=np.int32):
+    """Array version of QickConfig.us2cycles: times (us) to clock cycles of the tProc (default),
+    a generator (gen_ch) or a readout (ro_ch), rounded to the nearest cycle as in the scalar path.
+
+    Parameters
+    ----------
+    soccfg : QickConfig
+        firmware configuration
+    us : float or array
+        times, in us
+    as_float : bool
+        return the unrounded number of cycles
+    dtype : numpy dtype
+        integer type of the result (default: 32-bit, the width of tProc registers and data memory);
+        times out of its range raise a ValueError
+
+    Returns
+    -------
+    numpy.ndarray
+        number of cycles
+    """
+    cycles = np.asarray(us, dtype=float)*_fclk(soccfg, gen_ch, ro_ch)
+    if as_float:
+        return cycles
+    cycles = np.round(cycles)
+    info = np.iinfo(dtype)
+    bad = ~((cycles >= info.min) & (cycles <= info.max))
+    if np.any(bad):
+        raise ValueError("times %s us out of range for %s cycles" % (np.asarray(us)[bad], np.dtype(dtype).name))
+    return cycles.astype(dtype)
+
+def cycles2us_array(soccfg, cycles, gen_ch=None, ro_ch=None):
+    """Array version of QickConfig.cycles2us.
+    """
+    return np.asarray(cycles, dtype=float)/_fclk(soccfg, gen_ch, ro_ch)
+
+def _json_default(obj):
+    # numpy scalars in the config.
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return float(obj)
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError("%s is not JSON serializable" % (type(obj).__name__))
+
+class QickTrainingConfig(QickConfig):
+    """
+    QickTrainingConfig class
+    Firmware configuration of a QickTrainingSoc, without the hardware.
+
+    Built from a snapshot exported by QickTrainingSoc (dump_snapshot/save_snapshot), it has the
+    analysis, synthesis and simulator chains with their frequency settings, so frequency planning,
+    AnalysisChain/SynthesisChain math and program compilation can run on a machine without the board.
+    Methods that write to the firmware (qout, set_resonator, ...) need the QickTrainingSoc.
+    """
+    # Eager initialization by default.
+    lazy = False
+
+    def __init__(self, cfg=None):
+        """
+        Parameters
+        ----------
+        cfg : dict or str
+            config snapshot (dict, or a JSON string)
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        super().__init__(cfg)
+        if 'simu' in self._cfg:
+            # The chain descriptions are already part of the snapshot.
+            self.map_simu(describe=False)
+
+    @classmethod
+    def load_snapshot(cls, path):
+        """Config from a snapshot file written by save_snapshot (.json or .msgpack).
+        """
+        if os.path.splitext(path)[1] == '.msgpack':
+            if msgpack is None:
+                raise RuntimeError("msgpack is not installed")
+            with open(path, 'rb') as f:
+                return cls(msgpack.unpackb(f.read()))
+        with open(path, 'r') as f:
+            return cls(f.read())
+
+    def _timed(self, name, fn, *args, **kwargs):
+        t0 = time.perf_counter()
+        ret = fn(*args, **kwargs)
+        dt = time.perf_counter() - t0
+        if 'ready_times' not in self.__dict__:
+            self.ready_times = {}
+        self.ready_times[name] = dt
+        self.logger.info("%s ready in %.1f ms"%(name, dt*1e3))
+        return ret
+
+    def map_simu(self, describe=True):
         # list of simulator chains
-        self.simu = []
+        self._simu_names = []
         for simucfg in self['simu']:
             adcstr = self._describe_adc(simucfg['analysis']['adc']['id'])
             dacstr = self._describe_dac(simucfg['synthesis']['dac']['id'])
-            self.simu.append(SimuChain(self, simucfg, adcstr + " -> " + dacstr))
-        if self.simu:
-            self['extra_description'].append("\n\t%d resonator simulator chains:"%(len(self.simu)))
-            for i, simu in enumerate(self.simu):
-                self['extra_description'].append("\t%d:\t%s"%(i, simu.name))
+            self._simu_names.append(adcstr + " -> " + dacstr)
+
+        # In lazy mode, chains are built on first access.
+        if self.lazy:
+            self.simu = LazyList(len(self['simu']), self._build_simu)
+        else:
+            self.simu = [self._build_simu(i) for i in range(len(self['simu']))]
+
+        if describe and self['simu']:
+            self['extra_description'].append("\n\t%d resonator simulator chains:"%(len(self['simu'])))
+            for i, name in enumerate(self._simu_names):
+                self['extra_description'].append("\t%d:\t%s"%(i, name))
+
+    def _build_simu(self, i):
+        return self._timed('simu[%d]'%(i), SimuChain, self, self['simu'][i], self._simu_names[i], lazy=self.lazy)
+
+    def allocate_resonators(self, freqs, chains=None, max_offset=None):
+        """Assign resonator frequencies to simulator chains and channels, without lane collisions.
+        See ResonatorAllocator (max_offset: largest DDS offset, default half the channel spacing)
+        and ResonatorAllocator.allocate.
+        """
+        return ResonatorAllocator(self.simu, max_offset).allocate(freqs, chains)
+
+    def us2cycles_array(self, us, gen_ch=None, ro_ch=None, as_float=False, dtype=np.int32):
+        """Times (us, array) to clock cycles; see us2cycles_array.
+        """
+        return us2cycles_array(self, us, gen_ch, ro_ch, as_float, dtype)
+
+    def cycles2us_array(self, cycles, gen_ch=None, ro_ch=None):
+        return cycles2us_array(self, cycles, gen_ch, ro_ch)
+
+    def snapshot(self):
+        """Copy of the configuration, with the mixer settings of the simulator chains resolved.
+        """
+        cfg = copy.deepcopy(self.get_cfg())
+        for simucfg, simu in zip(cfg.get('simu', []), self.simu):
+            for chaincfg, chain in [(simucfg['analysis'], simu.analysis), (simucfg['synthesis'], simu.synthesis)]:
+                chaincfg['mixer'] = dict(chain.mixer)
+                chaincfg['nqz'] = int(chain.dict['nqz'])
+        return cfg
+
+    def dump_snapshot(self, fmt='json'):
+        """Config snapshot, as a JSON string (fmt='json') or msgpack bytes (fmt='msgpack').
+        Load it with QickTrainingConfig(...) or QickTrainingConfig.load_snapshot.
+        """
+        cfg = self.snapshot()
+        if fmt == 'json':
+            return json.dumps(cfg, default=_json_default)
+        elif fmt == 'msgpack':
+            if msgpack is None:
+                raise RuntimeError("msgpack is not installed")
+            return msgpack.packb(json.loads(json.dumps(cfg, default=_json_default)))
+        else:
+            raise ValueError("Unknown snapshot format %s" % (fmt))
+
+    def save_snapshot(self, path):
+        """Write the config snapshot to a file; the format is given by the extension (.json or .msgpack).
+        """
+        fmt = 'msgpack' if os.path.splitext(path)[1] == '.msgpack' else 'json'
+        data = self.dump_snapshot(fmt)
+        with open(path, 'wb' if fmt == 'msgpack' else 'w') as f:
+            f.write(data)
+
+class QickTrainingSoc(QickSoc, QickTrainingConfig):    
+
+    # Timing instrumentation (see enable_tracing).
+    tracer = None
+
+    # Constructor.
+    def __init__(self, bitfile, topology_cache=True, lazy=False, **kwargs):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        """
+        Constructor method
+
+        With topology_cache, the PFB connections traced from the firmware metadata are cached on disk
+        (keyed by a hash of the hwh file next to the bitfile), and later startups skip the tracing.
+
+        With lazy, each simulator chain is built on first access to soc.simu[i], and the mixer settings
+        of its analysis/synthesis chains are read from the RF blocks on first use.
+        The time to get each subsystem ready is logged (INFO) and kept in self.ready_times (s).
+        """
+        self.lazy = lazy
+
+        # Topology cache for the PFB drivers (used by their configure_connections).
+        self.topology_cache = None
+        if topology_cache and bitfile is not None:
+            hwh = os.path.splitext(bitfile)[0] + '.hwh'
+            if os.path.exists(hwh):
+                self.topology_cache = TopologyCache(hwh)
+
+        self._timed('QickSoc', QickSoc.__init__, self, bitfile, **kwargs)
+
+        if self.topology_cache is not None:
+            self.topology_cache.save()
 
+        self._timed('map_local', self.map_local)
+        self._timed('map_simu', self.map_simu)
+        self._timed('add_triggers', self.add_triggers)
+
+    def add_triggers(self):
         # Add triggers for Kidsim.
         tproccfg = self['tprocs'][0]
         if tproccfg['type']=='axis_tproc64x32_x8':
@@ -450,6 +1004,9 @@ class QickTrainingSoc(QickSoc, QickConfig):
             if pfb.HAS_KIDSIM:
                 thiscfg['subtype'] = 'sim'
                 thiscfg['kidsim'] = pfb.dict['kidsim']
+                kidsim = getattr(self, pfb.dict['kidsim'])
+                thiscfg['fr'] = kidsim.DF_DDS/1e6
+                thiscfg['L'] = kidsim.L
             thiscfg['fs'] = pfb.dict['freq']['fs']
             thiscfg['fs_ch'] = pfb.dict['freq']['fb']
             thiscfg['fc_ch'] = pfb.dict['freq']['fc']
@@ -462,6 +1019,9 @@ class QickTrainingSoc(QickSoc, QickConfig):
             if pfb.HAS_KIDSIM:
                 thiscfg['subtype'] = 'sim'
                 thiscfg['kidsim'] = pfb.dict['kidsim']
+                kidsim = getattr(self, pfb.dict['kidsim'])
+                thiscfg['fr'] = kidsim.DF_DDS/1e6
+                thiscfg['L'] = kidsim.L
             thiscfg['dac'] = pfb.dict['dac']
             thiscfg['pfb'] = pfb.fullpath
             thiscfg['fs'] = pfb.dict['freq']['fs']
@@ -491,7 +1051,54 @@ class QickTrainingSoc(QickSoc, QickConfig):
                 if not found:
                     raise RuntimeError("Could not find dual chain for PFB {}".format(ch_a['pfb']))
 
-    def config_resonator(self, simu_ch=0, q_adc=6, q_dac=0, f=500.0, df=2.0, dt=10.0, c0=0.99, c1=0.8, verbose=False):
+    def shadow_regs(self, enable=True):
+        """Enable or disable the register shadow of the PFB and kidsim drivers.
+
+        With the shadow enabled, register writes that would not change the register value are skipped.
+        Call shadow_invalidate() if the registers were changed by other means (e.g. a bitstream reload).
+        """
+        for block in self._shadow_blocks():
+            block.shadow_enable(enable)
+
+    def shadow_invalidate(self):
+        for block in self._shadow_blocks():
+            block.shadow_invalidate()
+
+    def shadow_stats(self, reset=False):
+        """Number of register writes done and skipped by each shadowed block.
+        """
+        return {block.fullpath : block.shadow_stats(reset) for block in self._shadow_blocks()}
+
+    def enable_tracing(self, size=1<<16, programs=True):
+        """Record the time spent configuring resonators, writing the PFB and kidsim registers and,
+        with programs, building, running and reading back AveragerProgramV2 programs (all instances).
+        Spans go to a ring buffer of size spans.
+
+        Returns
+        -------
+        Tracer
+            the tracer (also kept in self.tracer), with the summary report and Chrome trace export
+        """
+        self.disable_tracing()
+        self.tracer = Tracer(size)
+        self.tracer.instrument(self, [AveragerProgramV2] if programs and HAVE_TPROC_V2 else [])
+        return self.tracer
+
+    def disable_tracing(self):
+        """Remove the instrumentation (the spans stay in the tracer).
+        """
+        if self.tracer is not None:
+            self.tracer.unpatch()
+        self.tracer = None
+
+    def _shadow_blocks(self):
+        blocks = self.pfbs_in + self.pfbs_out
+        for pfb in self.pfbs_in:
+            if pfb.HAS_KIDSIM:
+                blocks.append(getattr(self, pfb.dict['kidsim']))
+        return blocks
+
+    def config_resonator(self, simu_ch=0, q_adc=6, q_dac=0, f=500.0, df=2.0, dt=10.0, c0=0.99, c1=0.8, verbose=False, force=False):
         """Configure the resonator simulator.
 
         The two qout values truncate the data at different points in the simulator.
@@ -523,15 +1130,11 @@ class QickTrainingSoc(QickSoc, QickConfig):
         c1 : float
             resonator parameter, in the range 0.0 - c0
             roughly speaking, this sets the depth of the resonator minimum
+        force : bool
+            rewrite all registers; by default, only what differs from the last configuration is written
         """
         simu = self.simu[simu_ch]
 
-        simu.analysis.qout(q_adc)
-        simu.synthesis.qout(q_dac)
-
-        # Disable all resonators.
-        simu.alloff()
-
         cfg = {'sel':'resonator', 'nstep':1}
         cfg['freq'] = f
         cfg['sweep_freq'] = df
@@ -541,4 +1144,576 @@ class QickTrainingSoc(QickSoc, QickConfig):
         cfg['iir_c0'] = c0
         cfg['iir_c1'] = c1
 
-        simu.set_resonator(cfg, verbose=verbose)
+        # Same per-chain lock as config_resonators.
+        with simu.lock:
+            simu.analysis.qout(q_adc, force=force)
+            simu.synthesis.qout(q_dac, force=force)
+
+            # Disable all other resonators.
+            lane = simu.analysis.freq2ch(f) % simu.L
+            simu.alloff(keep=None if force else [lane], force=force)
+
+            simu.set_resonator(cfg, verbose=verbose, force=force)
+
+    def config_resonators(self, table, q_adc=6, q_dac=0, alloff=True, workers=1, verbose=False):
+        """Configure several resonators, on any lanes and simulator chains, in one call.
+
+        The resonators are placed with allocate_resonators (so they do not collide on a kidsim lane),
+        then the registers of each chain are compiled at once and written.
+        The qout values are applied once per chain used.
+        With workers > 1, the chains are configured concurrently by a thread pool; each chain is locked while
+        it is configured (as in config_resonator). The timing (sum of the per-chain times, wall time and
+        their ratio, the speedup over the serial path) is logged and kept in self.config_timing.
+        Register writes through pynq MMIO are short Python calls that hold the GIL, so threads only pay off
+        if the writes block outside Python; on the mock backend they are slower than the serial path
+        (speedup below 1). Measure config_timing on the board before using them.
+
+        Parameters
+        ----------
+        table : list of dict, or structured array
+            one resonator per entry, with fields f (MHz) and optionally df (MHz), dt (us), c0, c1
+            (same meaning and defaults as in config_resonator) and chain (simulator index, -1 for any)
+        q_adc : int
+            number of bits to truncate at simulator input
+        q_dac : int
+            number of bits to truncate at simulator output
+        alloff : bool
+            disable all the other resonators of the chains used
+        workers : int
+            number of worker threads (default 1: configure the chains one after another)
+
+        Returns
+        -------
+        numpy.ndarray
+            ALLOC_DTYPE array: chain, channel, lane and DDS frequency of each resonator
+        """
+        def column(key, default):
+            if isinstance(table, np.ndarray):
+                if key in table.dtype.names:
+                    return np.asarray(table[key], dtype=float)
+                return np.full(len(table), default, dtype=float)
+            return np.array([entry.get(key, default) for entry in table], dtype=float)
+
+        f     = column('f', np.nan)
+        df    = column('df', 2.0)
+        dt    = column('dt', 10.0)
+        c0    = column('c0', 0.99)
+        c1    = column('c1', 0.8)
+        chain = column('chain', -1).astype(np.int64)
+        if np.any(np.isnan(f)):
+            raise ValueError("Every resonator needs a frequency f")
+
+        # Place all the resonators before touching the hardware.
+        alloc = self.allocate_resonators(f, chain)
+        if not np.all(alloc['ok']):
+            raise ValueError("Could not place resonators at %s MHz without lane collisions" % (f[~alloc['ok']]))
+
+        # One job per chain.
+        jobs = []
+        for c in np.unique(alloc['chain']):
+            sel = alloc['chain'] == c
+            jobs.append((c, self.simu[c], alloc[sel], df[sel], dt[sel], c0[sel], c1[sel], q_adc, q_dac, alloff, verbose))
+
+        t0 = time.perf_counter()
+        if workers is None or workers <= 1:
+            times = [self._config_chain(*job) for job in jobs]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(self._config_chain, *job) for job in jobs]
+                times = [future.result() for future in futures]
+        wall = time.perf_counter() - t0
+
+        serial = sum(times)
+        self.config_timing = {'chains'  : len(jobs),
+                              'workers' : workers,
+                              'serial'  : serial,
+                              'wall'    : wall,
+                              'speedup' : serial/wall if wall > 0 else 1.0}
+        self.logger.info("config_resonators %s"%(self.config_timing))
+
+        return alloc
+
+    def _config_chain(self, c, simu, alloc, df, dt, c0, c1, q_adc, q_dac, alloff, verbose):
+        # Configure the resonators of one simulator chain; returns the time it took (s).
+        t0 = time.perf_counter()
+        with simu.lock:
+            simu.analysis.qout(q_adc)
+            simu.synthesis.qout(q_dac)
+            if alloff:
+                simu.alloff(keep=alloc['lane'])
+
+            kidsim = simu.kidsim
+            regs, sweep_time, clamp = kidsim.compile_regs(alloc['channel'], alloc['dds_freq'],
+                                                          sweep_freq=df, sweep_time=dt, nstep=1,
+                                                          c0=c0, c1=c1, sel='resonator')
+            if np.any(clamp):
+                self.logger.warning("simu %d: sweep_time updated to %s us for channels %s"
+                                    % (c, sweep_time[clamp], alloc['channel'][clamp]))
+            kidsim.write_resonators(regs[~kidsim.unchanged(regs)], verbose=verbose)
+        return time.perf_counter() - t0
+
+    def run_batch(self, calls, pack=None):
+        """Run a list of driver operations in one call: over Pyro, one network round trip
+        instead of one per operation. Usually built with a BatchProxy (see pyro_batch).
+
+        Operations run in order; if one raises, the exception is passed on and the following ones are not run.
+
+        Parameters
+        ----------
+        calls : list
+            (op, path, name, value) tuples, on the object reached from the soc by path (a tuple of
+            attribute names and [key] items, e.g. ('simu', [0]) or (['tprocs'], [0])): op 'call' calls
+            method name with value = (args, kwargs), 'get' reads attribute name (the object itself if
+            name is None), 'set' sets it to value
+        pack : dict
+            send the arrays in the results as PackedArray, with these pack_arrays arguments (dtype, compress, ...)
+
+        Returns
+        -------
+        list
+            result of each operation (None for 'set')
+        """
+        results = []
+        for op, path, name, value in calls:
+            obj = self
+            for key in path + (name,):
+                if isinstance(key, str) and key.startswith('_'):
+                    raise AttributeError("private attribute %s is not accessible" % (key))
+            for key in path:
+                obj = obj[key[0]] if isinstance(key, list) else getattr(obj, key)
+            if op == 'call':
+                args, kwargs = value
+                results.append(getattr(obj, name)(*args, **kwargs))
+            elif op == 'get':
+                results.append(obj if name is None else getattr(obj, name))
+            elif op == 'set':
+                setattr(obj, name, value)
+                results.append(None)
+            else:
+                raise ValueError("unknown batch operation %s" % (op))
+        if pack is not None:
+            return pack_arrays(results, **pack)
+        return results
+
+# Readout timing of the qick_training firmware, in us.
+TOFF_RO  = 3.5  # readout trigger offset
+TOFF_RES = 0.8  # resonator trigger offset
+RES_PAD  = 0.2  # margin around the resonator jump
+
+# Lifetime distributions of the excited state: draw(rng, n, t1, **params) -> n lifetimes (us) of mean t1.
+DECAY_DISTRIBUTIONS = {
+    'expon'   : lambda rng, n, t1: t1*rng.exponential(size=n),
+    'gamma'   : lambda rng, n, t1, shape=2.0: (t1/shape)*rng.gamma(shape, size=n),
+    'weibull' : lambda rng, n, t1, shape=1.0: t1*rng.weibull(shape, size=n)/math.gamma(1+1/shape),
+    'fixed'   : lambda rng, n, t1: np.full(n, float(t1)),
+}
+
+class DelayTables():
+    """
+    DelayTables class
+    Jump-time tables of the T1 emulation (T1Program): random lifetimes, and a cache of the tables
+    and data memory images of seeded programs.
+
+    With a seed, a table only depends on (t1, decay_delay, reps, seed, distribution, clock), so repeated
+    builds, and the ground/excited programs of a pair, get the same table from the cache, and runs are
+    reproducible. Without a seed every build draws a new table, which is not cached.
+    Cached arrays are shared, and read-only.
+    """
+    def __init__(self, maxsize=32):
+        """
+        Parameters
+        ----------
+        maxsize : int
+            maximum number of tables kept
+        """
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock    = threading.Lock()
+        self.hits    = 0
+        self.misses  = 0
+
+    def draw(self, n, t1, decay_delay, seed=None, dist='expon', **params):
+        """Jump times (us) of n excited shots: lifetimes drawn from dist (a DECAY_DISTRIBUTIONS key)
+        with mean t1, clipped to decay_delay. t1 = 0 decays immediately, t1 < 0 never decays.
+        """
+        if t1 == 0:
+            return np.zeros(n)
+        elif t1 < 0:
+            return np.full(n, float(decay_delay))
+        if dist not in DECAY_DISTRIBUTIONS:
+            raise ValueError("unknown decay distribution %s, choose from %s" % (dist, list(DECAY_DISTRIBUTIONS)))
+        rng = np.random.default_rng(seed)
+        return np.minimum(DECAY_DISTRIBUTIONS[dist](rng, n, t1, **params), decay_delay)
+
+    def get(self, key, build):
+        """Value of build() (arrays, or a tuple of arrays), cached under key (None: not cached).
+        """
+        if key is None:
+            return build()
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+        value = build()
+        for arr in (value if isinstance(value, tuple) else (value,)):
+            arr.setflags(write=False)
+        with self.lock:
+            self.misses += 1
+            self.entries[key] = value
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {'size'   : len(self.entries),
+                'hits'   : self.hits,
+                'misses' : self.misses}
+
+# Tables of the readout programs.
+delay_tables = DelayTables()
+
+class T1Program(AveragerProgramV2):
+    """
+    T1Program class
+    Readout of the simulated resonator (from the readout labs).
+
+    The resonator is put in the excited state before the readout, and its lifetime extends past the
+    end of the readout. The simulator cannot decay randomly (it always decays after a fixed time), so
+    the resonator is set to decay after decay_delay, and the jump starts at lifetime-decay_delay:
+    the jump time of each rep is read from data memory (see jump_delays).
+
+    cfg keys: gen_ch, ro_ch, nqz, f_res, df_ro, ro_len, pulse_len, phase, pulse_gain, t_pulse, t_ro,
+    decay_delay, do_jump, t1 (negative for no decay, 0 to decay immediately), steps, and optionally
+    loops (number of steps loops, default 1), seed (for the random lifetimes, see DelayTables),
+    decay_dist (lifetime distribution, a DECAY_DISTRIBUTIONS key, default 'expon') and decay_params
+    (its parameters).
+    """
+    def initialize(self, cfg):
+        ro_ch = cfg['ro_ch']
+        gen_ch = cfg['gen_ch']
+        f_ro = cfg['f_res']+cfg['df_ro']
+
+        self.declare_gen(ch=gen_ch, nqz=cfg['nqz'])
+        self.declare_readout(ch=ro_ch, length=cfg['ro_len'])
+        self.add_readoutconfig(ch=ro_ch, name="myro", freq=f_ro, gen_ch=gen_ch)
+
+        self.add_pulse(ch=gen_ch, name="mypulse", ro_ch=ro_ch,
+                       style="const",
+                       freq=f_ro,
+                       length=cfg['pulse_len'],
+                       phase=cfg['phase'],
+                       gain=cfg['pulse_gain'],
+                      )
+
+        for i in range(cfg.get('loops', 1)):
+            self.add_loop("myloop%d"%(i+1), self.cfg["steps"])
+
+    def body(self, cfg):
+        # configure the readout
+        self.send_readoutconfig(ch=cfg['ro_ch'], name="myro", t=0)
+
+        # read a value from the data memory into the time register (s14)
+        self.add_macro(DerefDmem(reg="s14", idx='reps'))
+        if cfg['do_jump']:
+            self.trigger(pins=list(range(8,16)), t=None)
+
+        self.delay(RES_PAD+cfg['decay_delay']-TOFF_RES)
+        self.pulse(ch=cfg['gen_ch'], name="mypulse", t=cfg['t_pulse'])
+        self.trigger(ros=[cfg['ro_ch']], pins=[0], t=cfg['t_pulse']+cfg['t_ro']+TOFF_RO)
+        self.delay(cfg['decay_delay']+TOFF_RO)
+
+    def excited_delays(self, n):
+        """Jump times (us) of n excited shots: the resonator decays t1-distributed lifetimes before the readout.
+        """
+        cfg = self.cfg
+        return delay_tables.draw(n, cfg['t1'], cfg['decay_delay'], cfg.get('seed'),
+                                 cfg.get('decay_dist', 'expon'), **cfg.get('decay_params', {}))
+
+    def jump_delays(self):
+        """Resonator jump time (us) of each rep, in acquisition order.
+        """
+        return self.excited_delays(self.reps)
+
+    def table_key(self):
+        """Key of the jump-time table in delay_tables (None if it is not reproducible).
+        """
+        cfg = self.cfg
+        if cfg.get('seed') is None:
+            return None
+        return (type(self).jump_delays.__qualname__, cfg['t1'], cfg['decay_delay'], self.reps, cfg['seed'],
+                cfg.get('decay_dist', 'expon'), tuple(sorted(cfg.get('decay_params', {}).items())),
+                self.soccfg['tprocs'][0]['f_time'])
+
+    def compile_datamem(self):
+        self.delays, dmem = delay_tables.get(self.table_key(), self._datamem)
+        return dmem
+
+    def _datamem(self):
+        # the jump time for rep i will be dmem[reps - i]
+        delays = self.jump_delays()
+        dmem = np.zeros((self.reps+1,8), dtype=np.int32)
+        dmem[1:,0] = us2cycles_array(self.soccfg, delays[::-1])
+        return delays, dmem
+
+class ReadoutCalProgram(T1Program):
+    """
+    ReadoutCalProgram class
+    T1Program with ground and excited shots interleaved in one acquisition.
+
+    Even reps are ground-state shots (the resonator jumps and decays before the pulse), odd reps are
+    excited-state shots (as in T1Program with do_jump). Ground and excited shots are thus taken
+    under the same conditions, alternating, and split with split_shots.
+    """
+    def jump_delays(self):
+        delays = np.zeros(self.reps)
+        excited = self.states == 1
+        delays[excited] = self.excited_delays(np.count_nonzero(excited))
+        return delays
+
+    @property
+    def states(self):
+        """Prepared state of each rep, in acquisition order (0: ground, 1: excited).
+        """
+        return np.arange(self.reps) % 2
+
+    def split_shots(self, ro_index=0):
+        """Shots of the last acquisition, split by prepared state.
+
+        Returns
+        -------
+        numpy.ndarray
+            ground-state shots, (n, 2) array of I/Q values
+        numpy.ndarray
+            excited-state shots, (n, 2) array of I/Q values
+        """
+        # reps is the outermost loop
+        iq = self.get_raw()[ro_index].reshape([self.reps, -1, 2])
+        states = self.states
+        return iq[states == 0].reshape([-1, 2]), iq[states == 1].reshape([-1, 2])
+
+def _require_tproc_v2():
+    if not HAVE_TPROC_V2:
+        raise ImportError(TPROC_V2_ERROR)
+
+def max_reps(soccfg):
+    """Largest number of reps of a readout program (one data memory entry per rep).
+    """
+    return soccfg['tprocs'][0]['dmem_size'] - 1
+
+def readout_cfg(soccfg, config, reps, gen_ch=0, ro_ch=0, loops=1, chunked=False):
+    """Program config of the readout experiments, from the resonator, readout and sweep settings.
+    Also returns the qout values for config_resonator.
+    Unless chunked, reps must fit in the data memory.
+    """
+    _require_tproc_v2()
+    if not chunked and reps+1 > soccfg['tprocs'][0]['dmem_size']:
+        raise RuntimeError("reps=%d exceeds maximum of %d-1"%(reps, soccfg['tprocs'][0]['dmem_size']))
+
+    cfg = config.copy()
+    cfg['gen_ch'] = gen_ch
+    cfg['ro_ch'] = ro_ch
+    cfg['nqz'] = 1
+    cfg['phase'] = 0
+    cfg['loops'] = loops
+    cfg['decay_delay'] = cfg['t_ro'] + cfg['t_pulse'] + cfg['ro_len'] + 2*RES_PAD
+    if isinstance(cfg['decay_delay'], QickSweep):
+        cfg['decay_delay'] = cfg['decay_delay'].maxval()
+    q_dac = min(cfg['truncate'], 11)
+    q_adc = 6 + cfg['truncate']-q_dac
+    return cfg, q_adc, q_dac
+
+def prepare_program(soc, soccfg, config, reps, loops=1, gen_ch=0, ro_ch=0, cache=None):
+    """Configure the resonator and build the ground and excited readout programs (as in the readout labs).
+
+    Parameters
+    ----------
+    soc : QickTrainingSoc
+        board
+    soccfg : QickConfig
+        firmware configuration
+    config : dict
+        resonator (f_res, c0, c1, df_res, truncate, pulse_gain), readout (df_ro, t_pulse, t_ro, pulse_len,
+        ro_len) and sweep (steps, t1) settings
+    reps : int
+        number of shots per sweep point
+    loops : int
+        number of steps loops
+    cache : ProgramCache
+        program cache, used if config has a seed (default: always build)
+
+    Returns
+    -------
+    T1Program
+        ground-state program
+    T1Program
+        excited-state program
+    """
+    cfg, q_adc, q_dac = readout_cfg(soccfg, config, reps, gen_ch, ro_ch, loops)
+    soc.config_resonator(dt=cfg['decay_delay'], f=cfg['f_res'], df=-cfg['df_res'], c0=cfg['c0'], c1=cfg['c1'], q_dac=q_dac, q_adc=q_adc)
+
+    cache = _seeded_cache(cache, cfg)
+    progs = []
+    for do_jump in [False, True]:
+        cfg['do_jump'] = do_jump
+        progs.append(_build(cache, T1Program, soccfg, reps=reps, final_delay=1.0, cfg=cfg.copy()))
+    return progs
+
+def readout_runner(soc, soccfg, reps, loops=1, gen_ch=0, ro_ch=0, cache=None, analyze=None, lookahead=1, lock=None):
+    """AsyncRunner for a sweep of readout configs (as in prepare_program): the programs of the next
+    configs are built while the current one is acquired, and analyze runs while the next one is.
+
+    Parameters are as in prepare_program; analyze(config, iq) gets the ground and excited shots
+    ((n, 2) arrays of I/Q values) of a config, e.g. lambda config, iq: hist_process([iq[0][:,0], iq[0][:,1],
+    iq[1][:,0], iq[1][:,1]], plot=False). Without analyze, the result of a config is iq.
+
+    Returns
+    -------
+    AsyncRunner
+        the runner: results = await runner.run(configs) (in Jupyter), or runner.run_sync(configs)
+    """
+    _require_tproc_v2()
+
+    def prepare(config):
+        cfg, q_adc, q_dac = readout_cfg(soccfg, config, reps, gen_ch, ro_ch, loops)
+        progs = [_build(_seeded_cache(cache, cfg), T1Program, soccfg, reps=reps, final_delay=1.0, cfg=dict(cfg, do_jump=do_jump))
+                 for do_jump in [False, True]]
+        return cfg, q_adc, q_dac, progs
+
+    def configure(prepared):
+        cfg, q_adc, q_dac, progs = prepared
+        soc.config_resonator(dt=cfg['decay_delay'], f=cfg['f_res'], df=-cfg['df_res'], c0=cfg['c0'], c1=cfg['c1'], q_dac=q_dac, q_adc=q_adc)
+
+    def acquire(prepared):
+        progs = prepared[3]
+        for prog in progs:
+            prog.acquire(soc, soft_avgs=1)
+        return [prog.get_raw()[0].reshape([-1,2]) for prog in progs]
+
+    return AsyncRunner(prepare, configure, acquire, analyze, lookahead=lookahead, lock=lock)
+
+def readout_calibration(soc, soccfg, config, reps, loops=1, gen_ch=0, ro_ch=0, cache=None, progress=False):
+    """Readout calibration: ground and excited shots interleaved in one program and one acquisition.
+
+    Parameters are as in prepare_program; reps is the total number of shots per sweep point
+    (half ground, half excited). Beyond the data memory size, the shots are taken in blocks
+    (see acquire_blocks).
+
+    Returns
+    -------
+    dict
+        ground and excited: (n, 2) arrays of I/Q shots; hist: [ig, qg, ie, qe], the input of hist_process;
+        prog: the (last) ReadoutCalProgram
+    """
+    cfg, q_adc, q_dac = readout_cfg(soccfg, config, reps, gen_ch, ro_ch, loops, chunked=True)
+    soc.config_resonator(dt=cfg['decay_delay'], f=cfg['f_res'], df=-cfg['df_res'], c0=cfg['c0'], c1=cfg['c1'], q_dac=q_dac, q_adc=q_adc)
+
+    cfg['do_jump'] = True
+    if reps <= max_reps(soccfg):
+        prog = _build(_seeded_cache(cache, cfg), ReadoutCalProgram, soccfg, reps=reps, final_delay=1.0, cfg=cfg)
+        prog.acquire(soc, soft_avgs=1, progress=progress)
+        iq_g, iq_e = prog.split_shots()
+    else:
+        # Even blocks, so that every block has as many ground as excited shots.
+        block = max_reps(soccfg) - max_reps(soccfg) % 2
+        shots = acquire_blocks(soc, soccfg, ReadoutCalProgram, cfg, reps, block=block, cache=cache, progress=progress)
+        prog = shots['progs'][-1]
+        iq = shots['raw'][0].reshape([reps, -1, 2])
+        states = np.concatenate([p.states for p in shots['progs']])
+        iq_g, iq_e = iq[states == 0].reshape([-1, 2]), iq[states == 1].reshape([-1, 2])
+
+    return {'ground'  : iq_g,
+            'excited' : iq_e,
+            'hist'    : [iq_g[:,0], iq_g[:,1], iq_e[:,0], iq_e[:,1]],
+            'prog'    : prog}
+
+def acquire_blocks(soc, soccfg, cls, cfg, reps, block=None, cache=None, progress=False):
+    """Acquire a readout program with more reps than the data memory holds.
+
+    The reps are split in blocks that fit the data memory; each block is a program with its own
+    data memory table (and its own random lifetimes), and the raw data of the blocks are concatenated
+    along the reps axis, as if they came from one acquisition.
+    With cfg['seed'], the block seeds are derived from it, so the whole dataset is reproducible, and the
+    block programs are built through the cache. Without a seed, every block draws new lifetimes, and its
+    program is always built (a cached program would come back with the same draw).
+
+    Parameters
+    ----------
+    soc : QickTrainingSoc
+        board
+    soccfg : QickConfig
+        firmware configuration
+    cls : class
+        program class (T1Program or ReadoutCalProgram)
+    cfg : dict
+        program config (see readout_cfg)
+    reps : int
+        total number of reps
+    block : int
+        reps per block (default: the data memory size)
+    cache : ProgramCache
+        program cache, for seeded cfg (default: always build)
+
+    Returns
+    -------
+    dict
+        raw: list (one per readout) of the concatenated raw data (reps first);
+        delays: resonator jump time of each rep (us); progs: the programs of the blocks
+    """
+    _require_tproc_v2()
+    if block is None:
+        block = max_reps(soccfg)
+    block = min(block, max_reps(soccfg))
+
+    seed = cfg.get('seed')
+    if seed is None:
+        cache = None
+    else:
+        rng = np.random.default_rng(seed)
+    raw, delays, progs = [], [], []
+    for start in range(0, reps, block):
+        n = min(block, reps - start)
+        cfg_ = cfg if seed is None else dict(cfg, seed=int(rng.integers(2**63)))
+        prog = _build(cache, cls, soccfg, reps=n, final_delay=1.0, cfg=cfg_)
+        prog.acquire(soc, soft_avgs=1, progress=progress)
+        raw.append(prog.get_raw())
+        delays.append(prog.delays)
+        progs.append(prog)
+
+    return {'raw'    : [np.concatenate([r[i] for r in raw]) for i in range(len(raw[0]))],
+            'delays' : np.concatenate(delays),
+            'progs'  : progs}
+
+def t1_shots(soc, soccfg, config, reps, loops=1, gen_ch=0, ro_ch=0, block=None, cache=None, progress=False):
+    """T1 dataset of any size: excited-state shots with random lifetimes, taken in data-memory-sized blocks.
+    Parameters are as in prepare_program and acquire_blocks.
+
+    Returns
+    -------
+    dict
+        iq: (n, 2) array of I/Q shots (reps first, then sweep steps), and delays: jump time (us) of each rep
+    """
+    cfg, q_adc, q_dac = readout_cfg(soccfg, config, reps, gen_ch, ro_ch, loops, chunked=True)
+    soc.config_resonator(dt=cfg['decay_delay'], f=cfg['f_res'], df=-cfg['df_res'], c0=cfg['c0'], c1=cfg['c1'], q_dac=q_dac, q_adc=q_adc)
+
+    cfg['do_jump'] = True
+    shots = acquire_blocks(soc, soccfg, T1Program, cfg, reps, block=block, cache=cache, progress=progress)
+    return {'iq'     : shots['raw'][0].reshape([-1, 2]),
+            'delays' : shots['delays']}
+
+def _seeded_cache(cache, cfg):
+    # Programs draw their random lifetimes when they are built, and a cached program comes back with
+    # the same draw: only seeded programs go through the cache.
+    if cfg.get('seed') is None:
+        return None
+    return cache
+
+def _build(cache, cls, soccfg, **kwargs):
+    if cache is None:
+        return cls(soccfg, **kwargs)
+    return cache.build(cls, soccfg, **kwargs)